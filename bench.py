@@ -0,0 +1,162 @@
+"""
+Микробенчмарки функций, которые выполняются на каждое обновление.
+
+Замеряет сборку клавиатур, очистку названий от эмодзи, форматирование
+отчётов, проверку номера велосипеда и проверку прав доступа.
+Результаты можно сохранить как базовые и затем сравнивать с ними:
+
+    python bench.py --save              # записать bench_baseline.json
+    python bench.py --threshold 0.25    # упасть, если что-то стало медленнее на 25%
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from aiogram import types
+
+import bot as mhelperbot
+
+BASELINE_FILE = "bench_baseline.json"
+# Сколько раз повторять замер; берётся лучший результат
+REPEAT = 5
+
+
+def collect_benchmarks() -> dict:
+    """Возвращает {название: функция без аргументов}."""
+    benchmarks = {}
+
+    catalog = mhelperbot.catalog
+    for index, (category, works) in enumerate(catalog.categories.items(), start=1):
+        for size in sorted({0, len(works) // 2, len(works)}):
+            selected = works[:size]
+            benchmarks[f"works_keyboard[cat{index},{size}]"] = (
+                lambda category=category, selected=selected: mhelperbot.get_category_works_keyboard(category, selected)
+            )
+
+            def build_uncached(category=category, selected=frozenset(selected)):
+                catalog.build_works_keyboard(category, selected)
+
+            benchmarks[f"works_keyboard_build[cat{index},{size}]"] = build_uncached
+
+    benchmarks["categories_keyboard"] = mhelperbot.get_categories_keyboard
+    benchmarks["categories_keyboard_build"] = catalog._build_categories_keyboard
+    benchmarks["catalog_build"] = lambda: mhelperbot.Catalog(
+        mhelperbot.DEFAULT_REPAIR_CATEGORIES, mhelperbot.DEFAULT_LOCATIONS, mhelperbot.WORK_RENAMES
+    )
+
+    benchmarks["search_works[cached]"] = lambda: catalog.search_index.search("колод")
+    benchmarks["search_works[uncached]"] = lambda: catalog.search_index._search("колотки пер")
+
+    catalogue_work = "🛡️ Защита двигателя от закручивания"
+    custom_work = "👨‍🔧 Замена 🔩 болтов крепления ⚙️ вручную"
+    benchmarks["remove_emojis_and_strip"] = lambda: mhelperbot.remove_emojis_and_strip(custom_work)
+    benchmarks["dispatcher_work_name[catalogue]"] = lambda: mhelperbot.get_dispatcher_work_name(catalogue_work)
+    benchmarks["dispatcher_work_name[custom]"] = lambda: mhelperbot.get_dispatcher_work_name(custom_work)
+
+    works = list(catalog.categories["🚲 Рама и навесное"][:10])
+    mechanic = types.User(id=123456789, is_bot=False, first_name="Иван", username="ivan")
+    benchmarks["format_repair_summary"] = lambda: mhelperbot.format_repair_summary(
+        "AB123C", "Быстрый ремонт", "Пример1", works
+    )
+
+    def format_report():
+        works_list = "; ".join(mhelperbot.get_dispatcher_work_name(work) for work in works)
+        mhelperbot.format_dispatcher_report(
+            "AB123C", "Быстрый ремонт", "Пример1", works_list, mhelperbot.format_telegram_link(mechanic)
+        )
+
+    benchmarks["format_dispatcher_report"] = format_report
+
+    benchmarks["bike_id_pattern[valid]"] = lambda: mhelperbot.BIKE_ID_PATTERN.fullmatch("AB123C")
+    benchmarks["bike_id_pattern[invalid]"] = lambda: mhelperbot.BIKE_ID_PATTERN.fullmatch("ЧТО-ТО НЕ ТО")
+
+    benchmarks["is_authorized[mechanic]"] = lambda: mhelperbot.is_authorized(1000500)
+    benchmarks["is_authorized[stranger]"] = lambda: mhelperbot.is_authorized(42)
+    benchmarks["is_admin"] = lambda: mhelperbot.is_admin(2000050)
+    return benchmarks
+
+
+def measure(func) -> float:
+    """Лучшее время одного вызова в микросекундах."""
+    timer = timeit.Timer(func)
+    # autorange подбирает число вызовов так, чтобы замер длился не меньше 0.2 с
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=REPEAT, number=number)) / number * 1e6
+
+
+def run_benchmarks(pattern: str = None) -> dict:
+    """Запускает бенчмарки в отдельном каталоге с тестовыми списками доступа."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="mhelperbot-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            with open(mhelperbot.AUTHORIZED_USERS_FILE, "w") as f:
+                json.dump([str(1000000 + i) for i in range(1000)], f)
+            with open(mhelperbot.ADMINS_FILE, "w") as f:
+                json.dump([str(2000000 + i) for i in range(100)], f)
+            # Импортирует списки в базу и загружает справочники в память
+            mhelperbot.load_directory()
+            mhelperbot.warm_keyboard_cache()
+            return {
+                name: measure(func)
+                for name, func in collect_benchmarks().items()
+                if pattern is None or pattern in name
+            }
+        finally:
+            mhelperbot.directory.close()
+            os.chdir(cwd)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Возвращает список (название, было, стало) для замедлившихся бенчмарков."""
+    return [
+        (name, baseline[name], value)
+        for name, value in results.items()
+        if name in baseline and value > baseline[name] * (1 + threshold)
+    ]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих функций бота")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="файл с базовыми результатами")
+    parser.add_argument("--save", action="store_true", help="сохранить результаты как базовые")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="допустимое замедление относительно базовых результатов (0.25 = 25%%)")
+    parser.add_argument("-k", dest="pattern", help="запускать только бенчмарки, содержащие строку")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    baseline_path = os.path.abspath(args.baseline)
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args.pattern)
+    print(f"{'бенчмарк':<40}{'мкс':>12}{'база, мкс':>12}{'изменение':>12}")
+    for name, value in results.items():
+        if name in baseline:
+            change = f"{(value / baseline[name] - 1) * 100:+.1f}%"
+            print(f"{name:<40}{value:>12.3f}{baseline[name]:>12.3f}{change:>12}")
+        else:
+            print(f"{name:<40}{value:>12.3f}{'-':>12}{'-':>12}")
+
+    if args.save:
+        with open(baseline_path, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+        print(f"Базовые результаты сохранены в {baseline_path}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print(f"Замедление: {name}: {before:.3f} -> {after:.3f} мкс", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,50 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import csv
+import datetime
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import queue
 import re
+import sqlite3
+import tempfile
+import threading
+import time
 import uuid
-from aiogram import Bot, Dispatcher, Router, types, F
+from collections import OrderedDict, deque
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, StateFilter, Command
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import CommandStart, StateFilter, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
+from aiogram.webhook.aiohttp_server import setup_application
+
+try:
+    # Необязательная зависимость для экспорта в XLSX
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    # Необязательная зависимость для каталога работ в формате YAML
+    import yaml
+except ImportError:
+    yaml = None
 
 # Включаем логирование
 logging.basicConfig(
@@ -21,7 +55,49 @@ logging.basicConfig(
 # Замените 'YOUR_DUMMY_TOKEN_HERE' на токен, полученный от BotFather.
 BOT_TOKEN = "YOUR_DUMMY_TOKEN_HERE"
 
+# --- Режим получения обновлений ---
+# "polling" - long polling, "webhook" - HTTP-сервер для вебхуков Telegram.
+# Можно переопределить флагами командной строки, см. python bot.py --help
+RUN_MODE = "polling"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+# Публичный адрес, который будет передан в setWebhook (например, https://bot.example.com).
+# Если пусто, вебхук нужно зарегистрировать самостоятельно.
+WEBHOOK_URL = ""
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = ""
+# Сколько обновлений обрабатывается одновременно и сколько может ждать в очереди
+WEBHOOK_MAX_CONCURRENCY = 64
+WEBHOOK_MAX_BACKLOG = 1000
+
+# --- Метрики ---
+# Метрики в формате Prometheus отдаются по http://METRICS_HOST:METRICS_PORT/metrics.
+# 0 - не запускать сервер метрик. В многопроцессном режиме процесс N слушает METRICS_PORT + N.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+
+# --- Трассировка ---
+# Если включено, каждое обновление получает ID трассировки, а время работы
+# с хранилищами, файлами и Bot API записывается по шагам. Обновления дольше
+# SLOW_UPDATE_THRESHOLD секунд попадают в лог с разбивкой по шагам.
+TRACE_UPDATES = False
+SLOW_UPDATE_THRESHOLD = 1.0
+# Как часто проверять задержку цикла событий и с какой задержки (в секундах) писать в лог
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_THRESHOLD = 0.1
+
+# --- Многопроцессный режим ---
+# Количество рабочих процессов. При значении больше 1 главный процесс только
+# получает обновления и раздаёт их процессам по ID пользователя.
+WORKER_PROCESSES = 1
+# Сколько обновлений может ждать в очереди одного процесса
+WORKER_QUEUE_SIZE = 1000
+POLLING_TIMEOUT = 30
+
 # --- Настройки файлов конфигурации и супер-админа ---
+# Механики, администраторы и настройки хранятся в базе DATABASE_FILE.
+# Эти файлы из прежних версий бота импортируются в базу при первом запуске.
 AUTHORIZED_USERS_FILE = "authorized_users.json"
 ADMINS_FILE = "admins.json"
 CONFIG_FILE = "config.json"
@@ -29,86 +105,2043 @@ CONFIG_FILE = "config.json"
 # Замените 1234567890 на ваш реальный ID.
 SUPER_ADMIN_ID = 1234567890
 
-# Словарь для временного хранения отчётов
-pending_reports = {}
+# --- Настройки хранилища отчётов ---
+DATABASE_FILE = "mhelperbot.db"
+# Сколько секунд отчёт ждёт решения диспетчера, прежде чем будет удалён
+REPORT_TTL = 7 * 24 * 60 * 60
+# Сколько отчётов держать в памяти и сколько максимум хранить в базе
+REPORT_CACHE_SIZE = 1000
+REPORT_MAX_PENDING = 50000
+# Как часто (в секундах) удалять устаревшие отчёты
+REPORT_PURGE_INTERVAL = 10 * 60
+# Сколько последних ремонтов показывает /history и за сколько дней считает /stats
+HISTORY_LIMIT = 10
+STATS_DAYS = 30
+# Если велосипед уже отправлялся в течение стольких секунд, механик
+# и диспетчер видят предупреждение о возможном повторном отчёте
+DUPLICATE_REPORT_WINDOW = 24 * 60 * 60
+# По сколько строк читать историю при экспорте
+EXPORT_CHUNK_SIZE = 1000
+
+# --- Настройки хранилища состояний (FSM) ---
+# "sqlite" - формы переживают перезапуск, "memory" - хранятся только в памяти
+FSM_STORAGE = "sqlite"
+# Через сколько секунд после изменения форма записывается на диск.
+# Все изменения за это время объединяются в одну запись.
+FSM_FLUSH_DELAY = 0.5
+
+# --- Настройки исходящей очереди сообщений ---
+# Лимиты Telegram: около 30 сообщений в секунду на бота,
+# около 20 сообщений в минуту в группу и около 1 сообщения в секунду в личный чат
+OUTBOX_GLOBAL_RATE = 30.0
+OUTBOX_GROUP_RATE = 20 / 60
+OUTBOX_PRIVATE_RATE = 1.0
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_RETRIES = 5
+# Сколько секунд механик ждёт подтверждения доставки отчёта,
+# прежде чем увидит сообщение «отчёт в очереди»
+OUTBOX_REPLY_TIMEOUT = 5.0
+# Приоритеты: чем меньше число, тем раньше отправка
+PRIORITY_DISPATCHER = 0
+PRIORITY_MECHANIC = 1
+
+# --- Режим сводок для диспетчеров ---
+# Если включён, отчёты копятся и отправляются одним сообщением,
+# сгруппированным по локациям, когда пройдёт DIGEST_WINDOW секунд
+# или наберётся DIGEST_MAX_REPORTS отчётов.
+DIGEST_MODE = False
+DIGEST_WINDOW = 60
+DIGEST_MAX_REPORTS = 10
+# Предельная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# --- Отметка работ ---
+# Нажатия на работы сразу применяются в памяти, а клавиатура и состояние
+# формы обновляются один раз, когда механик не нажимал кнопки столько секунд
+WORK_TOGGLE_DEBOUNCE = 0.7
+
+# --- Трассировка обновлений ---
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class UpdateTrace:
+    """Шаги обработки одного обновления: (название, начало от старта обновления, длительность)."""
+
+    def __init__(self, update_id: int, event_type: str):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.update_id = update_id
+        self.event_type = event_type
+        self.started_at = time.perf_counter()
+        self.spans = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def format_spans(self) -> str:
+        if not self.spans:
+            return "no spans"
+        return ", ".join(
+            f"{name} +{offset * 1000:.1f}ms {duration * 1000:.1f}ms"
+            for name, offset, duration in sorted(self.spans, key=lambda span: span[1])
+        )
+
+
+@contextlib.contextmanager
+def trace_span(name: str):
+    """Записывает время блока в трассировку текущего обновления, если она ведётся."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, started - trace.started_at, time.perf_counter() - started))
+
 
-# --- Функции для работы с файлами конфигурации ---
+def traced(name: str):
+    """Декоратор: оборачивает функцию в trace_span. Без трассировки почти ничего не стоит."""
+
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if current_trace.get() is None:
+                    return await func(*args, **kwargs)
+                with trace_span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            with trace_span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# --- Функции для чтения файлов конфигурации прежних версий ---
+def read_json_file(path, default):
+    """
+    Читает JSON-файл. Если файла нет, возвращает default.
+    Если файл повреждён, выбрасывает исключение.
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+@traced("file.load_authorized_users")
 def load_authorized_users():
     """Загружает список авторизованных пользователей из JSON-файла."""
-    if os.path.exists(AUTHORIZED_USERS_FILE):
-        try:
-            with open(AUTHORIZED_USERS_FILE, "r") as f:
-                return set(json.load(f))
-        except (IOError, json.JSONDecodeError):
-            logging.error("Failed to load authorized users file. Starting with an empty list.")
-    return set()
-
-def save_authorized_users(user_ids):
-    """Сохраняет список авторизованных пользователей в JSON-файл."""
-    try:
-        with open(AUTHORIZED_USERS_FILE, "w") as f:
-            json.dump(list(user_ids), f)
-    except IOError:
-        logging.error("Failed to save authorized users file.")
+    return set(read_json_file(AUTHORIZED_USERS_FILE, []))
 
+@traced("file.load_admins")
 def load_admins():
     """Загружает список администраторов из JSON-файла."""
-    if os.path.exists(ADMINS_FILE):
-        try:
-            with open(ADMINS_FILE, "r") as f:
-                return set(json.load(f))
-        except (IOError, json.JSONDecodeError):
-            logging.error("Failed to load admins file. Starting with an empty list.")
-    return set()
-
-def save_admins(admin_ids):
-    """Сохраняет список администраторов в JSON-файл."""
-    try:
-        with open(ADMINS_FILE, "w") as f:
-            json.dump(list(admin_ids), f)
-    except IOError:
-        logging.error("Failed to save admins file.")
+    return set(read_json_file(ADMINS_FILE, []))
 
+@traced("file.load_config")
 def load_config():
     """Загружает конфигурацию из JSON-файла."""
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, "r") as f:
-                return json.load(f)
-        except (IOError, json.JSONDecodeError):
-            logging.error("Failed to load config file. Starting with default settings.")
-    return {}
-
-def save_config(config_data):
-    """Сохраняет конфигурацию в JSON-файл."""
-    try:
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config_data, f, indent=4)
-    except IOError:
-        logging.error("Failed to save config file.")
+    return read_json_file(CONFIG_FILE, {})
 
 def get_dispatcher_chat_id():
-    """Получает ID чата диспетчера из файла конфигурации."""
-    config = load_config()
-    return config.get("dispatcher_chat_id")
+    """Получает ID чата диспетчера из настроек."""
+    return config_cache.get("dispatcher_chat_id")
+
+
+def open_database(path: str) -> sqlite3.Connection:
+    """Открывает базу SQLite в режиме WAL."""
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# --- Справочники: пользователи, роли, настройки, каталог работ ---
+# Как часто (в секундах) проверять, не изменились ли справочники в базе
+DIRECTORY_CHECK_INTERVAL = 1.0
+# Через сколько секунд после изменения списки и настройки записываются в базу.
+# Все изменения за это время объединяются в одну запись.
+DIRECTORY_FLUSH_DELAY = 0.5
+
+ROLE_MECHANIC = "mechanic"
+ROLE_ADMIN = "admin"
+ROLES = {ROLE_MECHANIC: "Механик", ROLE_ADMIN: "Администратор"}
+
+# Разделы справочников и их таблицы. Триггеры увеличивают ревизию раздела
+# при любом изменении строк, поэтому бот замечает и правки из другого
+# процесса или из консоли sqlite3.
+DIRECTORY_AREAS = {
+    "users": ("user_roles",),
+    "settings": ("settings",),
+    "catalog": ("locations", "categories", "works", "category_works"),
+}
+
+
+class Directory:
+    """
+    Механики, администраторы, роли, настройки, локации и каталог работ в SQLite.
+    Бот держит всё это в памяти и перечитывает раздел, только когда
+    меняется его ревизия. Методы блокирующие: из обработчиков их вызывают
+    через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._revisions = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_database(self.path)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS roles (
+                    name TEXT PRIMARY KEY,
+                    title TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS user_roles (
+                    user_id TEXT NOT NULL,
+                    role TEXT NOT NULL REFERENCES roles (name),
+                    added_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, role)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_user_roles_role ON user_roles (role);
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS locations (
+                    name TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS categories (
+                    category_id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE,
+                    position INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS works (
+                    work_id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                );
+                CREATE TABLE IF NOT EXISTS category_works (
+                    category_id INTEGER NOT NULL REFERENCES categories (category_id),
+                    work_id INTEGER NOT NULL REFERENCES works (work_id),
+                    position INTEGER NOT NULL,
+                    PRIMARY KEY (category_id, work_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS directory_revisions (
+                    area TEXT PRIMARY KEY,
+                    revision INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_at REAL NOT NULL
+                );
+                """
+            )
+            triggers = []
+            for area, tables in DIRECTORY_AREAS.items():
+                for table in tables:
+                    for action in ("INSERT", "UPDATE", "DELETE"):
+                        triggers.append(
+                            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{action.lower()} AFTER {action} ON {table} "
+                            f"BEGIN UPDATE directory_revisions SET revision = revision + 1 WHERE area = '{area}'; END;"
+                        )
+            self._conn.executescript("\n".join(triggers))
+            self._conn.executemany("INSERT OR IGNORE INTO roles (name, title) VALUES (?, ?)", ROLES.items())
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO directory_revisions (area, revision) VALUES (?, 0)",
+                [(area,) for area in DIRECTORY_AREAS],
+            )
+        return self._conn
+
+    def revisions(self) -> dict:
+        """
+        Ревизии разделов: {раздел: номер}.
+        PRAGMA data_version меняется, только когда базу изменило другое
+        соединение, поэтому пока никто ничего не записал, таблица не читается.
+        """
+        with self._lock:
+            db = self._db()
+            version = db.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._data_version:
+                self._data_version = version
+                self._revisions = {
+                    row["area"]: row["revision"]
+                    for row in db.execute("SELECT area, revision FROM directory_revisions")
+                }
+            return dict(self._revisions)
+
+    def read(self, areas) -> dict:
+        """Читает разделы: users - {роль: множество ID}, settings - dict, catalog - (категории, локации)."""
+        result = {}
+        with self._lock:
+            db = self._db()
+            if "users" in areas:
+                members = {role: set() for role in ROLES}
+                for row in db.execute("SELECT user_id, role FROM user_roles"):
+                    members.setdefault(row["role"], set()).add(row["user_id"])
+                result["users"] = members
+            if "settings" in areas:
+                result["settings"] = {
+                    row["key"]: json.loads(row["value"]) for row in db.execute("SELECT key, value FROM settings")
+                }
+            if "catalog" in areas:
+                categories = {
+                    row["name"]: [] for row in db.execute("SELECT name FROM categories ORDER BY position")
+                }
+                for row in db.execute(
+                    "SELECT c.name AS category, w.name AS work FROM category_works cw "
+                    "JOIN categories c ON c.category_id = cw.category_id "
+                    "JOIN works w ON w.work_id = cw.work_id "
+                    "ORDER BY c.position, cw.position"
+                ):
+                    categories[row["category"]].append(row["work"])
+                locations = [row["name"] for row in db.execute("SELECT name FROM locations ORDER BY position")]
+                result["catalog"] = (categories, locations)
+        return result
+
+    def apply_role_changes(self, changes: dict):
+        """Применяет изменения ролей {(роль, ID): True - выдать, False - отозвать} одной транзакцией."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN")
+                db.executemany(
+                    "INSERT OR IGNORE INTO user_roles (user_id, role, added_at) VALUES (?, ?, ?)",
+                    [(user_id, role, now) for (role, user_id), granted in changes.items() if granted],
+                )
+                db.executemany(
+                    "DELETE FROM user_roles WHERE user_id = ? AND role = ?",
+                    [(user_id, role) for (role, user_id), granted in changes.items() if not granted],
+                )
+
+    def save_settings(self, settings: dict):
+        """Записывает настройки. Ключи, которых нет в settings, не трогает."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN")
+                db.executemany(
+                    "INSERT INTO settings (key, value) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value WHERE value != excluded.value",
+                    [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()],
+                )
+
+    @staticmethod
+    def _write_catalog(db: sqlite3.Connection, categories: dict, locations: list):
+        """Заменяет каталог и локации. Вызывается внутри транзакции."""
+        db.execute("DELETE FROM category_works")
+        db.execute("DELETE FROM categories")
+        db.execute("DELETE FROM locations")
+        db.executemany("INSERT INTO locations (name, position) VALUES (?, ?)",
+                       [(name, position) for position, name in enumerate(dict.fromkeys(locations))])
+        for category_position, (category, works) in enumerate(categories.items()):
+            category_id = db.execute(
+                "INSERT INTO categories (name, position) VALUES (?, ?)", (category, category_position)
+            ).lastrowid
+            for work_position, work in enumerate(dict.fromkeys(works)):
+                db.execute("INSERT OR IGNORE INTO works (name) VALUES (?)", (work,))
+                work_id = db.execute("SELECT work_id FROM works WHERE name = ?", (work,)).fetchone()[0]
+                db.execute("INSERT INTO category_works (category_id, work_id, position) VALUES (?, ?, ?)",
+                           (category_id, work_id, work_position))
+        db.execute("DELETE FROM works WHERE work_id NOT IN (SELECT work_id FROM category_works)")
+
+    def save_catalog(self, categories: dict, locations: list):
+        """Заменяет каталог работ и локации одной транзакцией."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                self._write_catalog(db, categories, locations)
+
+    @staticmethod
+    def _import_json_files(db: sqlite3.Connection) -> dict:
+        """Переносит в базу механиков, администраторов и настройки из JSON-файлов. Вызывается внутри транзакции."""
+        now = time.time()
+        counts = {}
+        for role, load in ((ROLE_MECHANIC, load_authorized_users), (ROLE_ADMIN, load_admins)):
+            user_ids = load()
+            db.executemany("INSERT OR IGNORE INTO user_roles (user_id, role, added_at) VALUES (?, ?, ?)",
+                           [(str(user_id), role, now) for user_id in user_ids])
+            counts[role] = len(user_ids)
+        config = load_config()
+        db.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                       [(key, json.dumps(value, ensure_ascii=False)) for key, value in config.items()])
+        counts["settings"] = len(config)
+        return counts
+
+    def import_json_files(self) -> dict:
+        """Переносит в базу данные из JSON-файлов. Уже имеющиеся в базе записи остаются."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                return self._import_json_files(db)
+
+    def migrate(self, default_categories: dict, default_locations: list):
+        """
+        При первом запуске переносит в базу JSON-файлы прежних версий
+        и заполняет каталог значениями по умолчанию из bot.py.
+        """
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                applied = {row["name"] for row in db.execute("SELECT name FROM migrations")}
+                if "json_files" not in applied:
+                    try:
+                        counts = self._import_json_files(db)
+                    except (IOError, ValueError) as e:
+                        # Файл повреждён: не отмечаем импорт, чтобы повторить его после исправления
+                        logging.error(f"Failed to import JSON configuration files: {e}")
+                    else:
+                        logging.info(f"Imported JSON configuration files into {self.path}: {counts}")
+                        db.execute("INSERT INTO migrations (name, applied_at) VALUES (?, ?)",
+                                   ("json_files", time.time()))
+                if "default_catalog" not in applied:
+                    if db.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 0:
+                        self._write_catalog(db, default_categories, default_locations)
+                    db.execute("INSERT INTO migrations (name, applied_at) VALUES (?, ?)",
+                               ("default_catalog", time.time()))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+directory = Directory()
+
+
+# --- Отложенная запись ---
+class FlushScheduler:
+    """
+    Запускает flush() через delay секунд после первого изменения, а не на каждое.
+    Пока предыдущий flush не закончился, новый не запускается и откладывается ещё на delay.
+    """
+
+    def __init__(self, flush, delay: float):
+        self.flush = flush
+        self.delay = delay
+        self._handle = None
+        self._task = None
+
+    def schedule(self):
+        """Планирует flush, если он ещё не запланирован. Вызывается внутри цикла событий."""
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self.delay, self._start)
+
+    def _start(self):
+        self._handle = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.flush())
+        else:
+            # Предыдущая запись ещё идёт: попробуем позже
+            self.schedule()
+
+    async def close(self):
+        """Отменяет запланированный запуск и дожидается уже идущего flush."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._task is not None:
+            await self._task
+
+
+class KeyedLocks:
+    """Блокировки asyncio по ключу (пользователю, сводке). Создаются при первом обращении."""
+
+    def __init__(self):
+        self._locks = {}
+
+    def __call__(self, key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def discard(self, key):
+        """Забывает блокировку ключа, который больше не понадобится."""
+        self._locks.pop(key, None)
+
+
+# --- Отложенная запись справочников ---
+class DeferredWriter:
+    """
+    Записывает изменения справочников в фоновом потоке.
+    schedule() только помечает раздел «грязным»; через flush_delay берётся
+    снимок изменений и записывается одним вызовом save. Если запись
+    не удалась, изменения возвращаются через restore и запись повторяется.
+    """
+
+    def __init__(self, flush_delay: float = DIRECTORY_FLUSH_DELAY):
+        self._pending = {}
+        self._writing = set()
+        self._scheduler = FlushScheduler(self.flush, flush_delay)
+
+    def is_pending(self, key) -> bool:
+        """True, если изменения ещё не записаны: такой раздел нельзя перечитывать из базы."""
+        return key in self._pending or key in self._writing
+
+    def schedule(self, key, save, snapshot, restore=None):
+        """
+        save(data) записывает данные, snapshot() возвращает их для записи,
+        restore(data) возвращает незаписанные данные обратно после ошибки.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий (скрипты, бенчмарки) пишем сразу
+            save(snapshot())
+            return
+        self._pending[key] = (save, snapshot, restore)
+        self._scheduler.schedule()
+
+    async def flush(self):
+        """Записывает все накопленные изменения."""
+        pending, self._pending = self._pending, {}
+        # Все разделы помечаются сразу: пока пишется первый, остальные
+        # тоже не должны перечитываться из базы (см. is_pending)
+        self._writing.update(pending)
+        try:
+            for key, (save, snapshot, restore) in pending.items():
+                data = snapshot()
+                try:
+                    await asyncio.to_thread(save, data)
+                except sqlite3.Error as e:
+                    logging.error(f"Failed to save {key}: {e}. Will retry.")
+                    if restore is not None:
+                        restore(data)
+                    self._pending.setdefault(key, (save, snapshot, restore))
+                    self._scheduler.schedule()
+                finally:
+                    self._writing.discard(key)
+        finally:
+            self._writing.difference_update(pending)
+
+    async def close(self):
+        await self._scheduler.close()
+        await self.flush()
+
+
+deferred_writer = DeferredWriter()
+
+
+# --- Кэш списков доступа ---
+class AccessCache:
+    """
+    Держит списки механиков и администраторов в памяти, поэтому проверка
+    прав - поиск в множестве. Списки читаются из базы при запуске и когда
+    они меняются в базе (см. watch_directory), а админ-обработчики
+    обновляют множества на месте и ставят запись в очередь deferred_writer.
+    """
+
+    def __init__(self):
+        self.lookups = 0
+        self.reloads = 0
+        self._users = set()
+        self._admins = set()
+        self._changes = {}
+
+    def replace(self, members: dict) -> bool:
+        """
+        Подменяет списки прочитанными из базы. Пока в памяти есть
+        незаписанные изменения, ничего не делает и возвращает False.
+        """
+        if deferred_writer.is_pending("users"):
+            return False
+        self._users = members.get(ROLE_MECHANIC, set())
+        self._admins = members.get(ROLE_ADMIN, set())
+        self.reloads += 1
+        return True
+
+    def is_admin(self, user_id) -> bool:
+        self.lookups += 1
+        user_id = str(user_id)
+        return user_id == str(SUPER_ADMIN_ID) or user_id in self._admins
+
+    def is_authorized(self, user_id) -> bool:
+        self.lookups += 1
+        user_id = str(user_id)
+        return user_id in self._users or user_id in self._admins or user_id == str(SUPER_ADMIN_ID)
+
+    def users(self) -> frozenset:
+        return frozenset(self._users)
+
+    def admins(self) -> frozenset:
+        return frozenset(self._admins)
+
+    def update_role(self, role: str, user_ids, granted: bool) -> list:
+        """
+        Выдаёт (granted=True) или снимает роль сразу у нескольких пользователей.
+        Множество в памяти меняется за один раз, а в базу ставится одна запись.
+        Возвращает ID, у которых роль действительно изменилась.
+        """
+        members = self._users if role == ROLE_MECHANIC else self._admins
+        changed = [user_id for user_id in dict.fromkeys(user_ids) if (user_id in members) != granted]
+        if not changed:
+            return changed
+        if granted:
+            members.update(changed)
+        else:
+            members.difference_update(changed)
+        for user_id in changed:
+            self._changes[(role, user_id)] = granted
+        deferred_writer.schedule("users", directory.apply_role_changes, self._take_changes, self._restore_changes)
+        return changed
+
+    def add_user(self, user_id: str) -> bool:
+        """Добавляет механика. Возвращает False, если он уже был в списке."""
+        return bool(self.update_role(ROLE_MECHANIC, [user_id], True))
+
+    def remove_user(self, user_id: str) -> bool:
+        """Удаляет механика. Возвращает False, если его не было в списке."""
+        return bool(self.update_role(ROLE_MECHANIC, [user_id], False))
+
+    def add_admin(self, user_id: str) -> bool:
+        """Добавляет администратора. Возвращает False, если он уже был в списке."""
+        return bool(self.update_role(ROLE_ADMIN, [user_id], True))
+
+    def remove_admin(self, user_id: str) -> bool:
+        """Удаляет администратора. Возвращает False, если его не было в списке."""
+        return bool(self.update_role(ROLE_ADMIN, [user_id], False))
+
+    def _take_changes(self) -> dict:
+        changes, self._changes = self._changes, {}
+        return changes
+
+    def _restore_changes(self, changes: dict):
+        # Более поздние изменения важнее возвращаемых
+        self._changes = {**changes, **self._changes}
+
+    def stats(self) -> dict:
+        """Счётчики для мониторинга."""
+        return {
+            "lookups": self.lookups,
+            "reloads": self.reloads,
+            "users": len(self._users),
+            "admins": len(self._admins),
+        }
+
+
+acl_cache = AccessCache()
 
 def is_admin(user_id):
     """Проверяет, является ли пользователь администратором."""
-    admins = load_admins()
-    return str(user_id) == str(SUPER_ADMIN_ID) or str(user_id) in admins
+    return acl_cache.is_admin(user_id)
 
 def is_authorized(user_id):
     """
     Проверяет, авторизован ли пользователь.
     Пользователь авторизован, если он есть в списке механиков или администраторов.
     """
-    authorized_users = load_authorized_users()
-    admins = load_admins()
-    return str(user_id) in authorized_users or str(user_id) in admins or str(user_id) == str(SUPER_ADMIN_ID)
+    return acl_cache.is_authorized(user_id)
+
+
+class ConfigCache:
+    """Настройки бота в памяти. Читаются из базы вместе с остальными справочниками."""
+
+    def __init__(self):
+        self._config = {}
+
+    def replace(self, config: dict) -> bool:
+        if deferred_writer.is_pending("settings"):
+            return False
+        self._config = config
+        return True
+
+    def get(self, key, default=None):
+        return self._config.get(key, default)
+
+    def set(self, key, value):
+        self._config = {**self._config, key: value}
+        deferred_writer.schedule("settings", directory.save_settings, lambda: self._config)
+
+
+config_cache = ConfigCache()
+
+
+# --- Хранилище отчётов, ожидающих решения диспетчера ---
+class ReportStore:
+    """
+    Отчёты, ожидающие решения диспетчера.
+    Хранятся в SQLite, поэтому переживают перезапуск бота; последние
+    отчёты дополнительно держатся в памяти. Устаревшие записи удаляются
+    по TTL, а при превышении лимита удаляются самые старые.
+    Методы блокирующие: из обработчиков их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE, ttl: float = REPORT_TTL,
+                 cache_size: int = REPORT_CACHE_SIZE, max_reports: int = REPORT_MAX_PENDING):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.max_reports = max_reports
+        self._conn = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_database(self.path)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS pending_reports (
+                    report_key TEXT PRIMARY KEY,
+                    bike_id TEXT NOT NULL,
+                    mechanic_id INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_pending_reports_mechanic ON pending_reports (mechanic_id);
+                CREATE INDEX IF NOT EXISTS idx_pending_reports_bike ON pending_reports (bike_id);
+                CREATE INDEX IF NOT EXISTS idx_pending_reports_created ON pending_reports (created_at);
+                CREATE TABLE IF NOT EXISTS report_decisions (
+                    report_key TEXT PRIMARY KEY,
+                    decision TEXT NOT NULL,
+                    dispatcher_name TEXT,
+                    decided_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS report_digests (
+                    digest_id TEXT PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER,
+                    items TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                """
+            )
+        return self._conn
+
+    def _remember(self, report_key: str, data: dict, created_at: float):
+        if self.cache_size <= 0:
+            return
+        self._cache[report_key] = (data, created_at)
+        self._cache.move_to_end(report_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _is_expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl
+
+    @traced("storage.reports.put")
+    def put(self, report_key: str, data: dict):
+        """Сохраняет отчёт. data должен содержать bike_id и mechanic_id."""
+        created_at = time.time()
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO pending_reports (report_key, bike_id, mechanic_id, data, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (report_key, data["bike_id"], data["mechanic_id"], json.dumps(data, ensure_ascii=False), created_at),
+            )
+            self._remember(report_key, data, created_at)
+
+    @traced("storage.reports.get")
+    def get(self, report_key: str):
+        """Возвращает данные отчёта или None, если его нет или он устарел."""
+        with self._lock:
+            cached = self._cache.get(report_key)
+            if cached is not None:
+                data, created_at = cached
+                if self._is_expired(created_at):
+                    del self._cache[report_key]
+                    return None
+                self._cache.move_to_end(report_key)
+                return dict(data)
+
+            row = self._db().execute(
+                "SELECT data, created_at FROM pending_reports WHERE report_key = ?", (report_key,)
+            ).fetchone()
+            if row is None or self._is_expired(row["created_at"]):
+                return None
+            data = json.loads(row["data"])
+            self._remember(report_key, data, row["created_at"])
+            return dict(data)
+
+    @traced("storage.reports.delete")
+    def delete(self, report_key: str) -> bool:
+        """Удаляет отчёт. Возвращает False, если его уже не было."""
+        with self._lock:
+            self._cache.pop(report_key, None)
+            cursor = self._db().execute("DELETE FROM pending_reports WHERE report_key = ?", (report_key,))
+            return cursor.rowcount > 0
+
+    @traced("storage.reports.claim")
+    def claim(self, report_key: str, decision: str, dispatcher_name: str = None) -> tuple:
+        """
+        Атомарно забирает отчёт для решения диспетчера: записывает решение
+        и удаляет отчёт из ожидающих в одной транзакции, поэтому решение
+        применяется ровно один раз, даже если диспетчеры нажали кнопки
+        одновременно в разных процессах.
+        Возвращает (данные отчёта, None) для первого решения,
+        (None, {"decision", "dispatcher_name"}) если решение уже принято
+        и (None, None), если отчёта нет или он устарел.
+        """
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute(
+                    "SELECT decision, dispatcher_name FROM report_decisions WHERE report_key = ?", (report_key,)
+                ).fetchone()
+                if row is not None:
+                    return None, dict(row)
+                row = db.execute(
+                    "SELECT data, created_at FROM pending_reports WHERE report_key = ?", (report_key,)
+                ).fetchone()
+                if row is None or self._is_expired(row["created_at"]):
+                    return None, None
+                db.execute(
+                    "INSERT INTO report_decisions (report_key, decision, dispatcher_name, decided_at) VALUES (?, ?, ?, ?)",
+                    (report_key, decision, dispatcher_name, time.time()),
+                )
+                db.execute("DELETE FROM pending_reports WHERE report_key = ?", (report_key,))
+                self._cache.pop(report_key, None)
+                return json.loads(row["data"]), None
+
+    @traced("storage.reports.find")
+    def _find(self, column: str, value):
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT report_key, data FROM pending_reports WHERE {column} = ? AND created_at >= ? "
+                "ORDER BY created_at",
+                (value, time.time() - self.ttl),
+            ).fetchall()
+        return {row["report_key"]: json.loads(row["data"]) for row in rows}
+
+    def find_by_mechanic(self, mechanic_id: int) -> dict:
+        """Отчёты механика, ожидающие решения: {ключ отчёта: данные}."""
+        return self._find("mechanic_id", mechanic_id)
+
+    def find_by_bike(self, bike_id: str) -> dict:
+        """Отчёты по велосипеду, ожидающие решения: {ключ отчёта: данные}."""
+        return self._find("bike_id", bike_id)
+
+    @traced("storage.reports.count")
+    def count(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM pending_reports").fetchone()[0]
+
+    @traced("storage.reports.save_digest")
+    def save_digest(self, digest_id: str, digest: dict):
+        """Сохраняет сводку: chat_id, message_id (None, пока не отправлена) и items."""
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO report_digests (digest_id, chat_id, message_id, items, created_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (digest_id) DO UPDATE SET message_id = excluded.message_id, items = excluded.items",
+                (digest_id, digest["chat_id"], digest["message_id"],
+                 json.dumps(digest["items"], ensure_ascii=False), time.time()),
+            )
+
+    @traced("storage.reports.get_digest")
+    def get_digest(self, digest_id: str):
+        with self._lock:
+            row = self._db().execute(
+                "SELECT chat_id, message_id, items FROM report_digests WHERE digest_id = ?", (digest_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"chat_id": row["chat_id"], "message_id": row["message_id"], "items": json.loads(row["items"])}
+
+    @traced("storage.reports.resolve_digest_item")
+    def resolve_digest_item(self, digest_id: str, report_key: str, status: str):
+        """
+        Записывает статус одной строки сводки и возвращает сводку со всеми
+        статусами. Чтение и запись идут в одной транзакции, поэтому решения
+        диспетчеров из разных процессов не затирают друг друга.
+        Возвращает None, если сводки нет.
+        """
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute(
+                    "SELECT chat_id, message_id, items FROM report_digests WHERE digest_id = ?", (digest_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                items = json.loads(row["items"])
+                for item in items:
+                    if item["key"] == report_key:
+                        item["status"] = status
+                db.execute(
+                    "UPDATE report_digests SET items = ? WHERE digest_id = ?",
+                    (json.dumps(items, ensure_ascii=False), digest_id),
+                )
+        return {"chat_id": row["chat_id"], "message_id": row["message_id"], "items": items}
+
+    @traced("storage.reports.mark_digest_sent")
+    def mark_digest_sent(self, digest_id: str, message_id: int):
+        """
+        Записывает message_id отправленной сводки и возвращает её вместе со статусами,
+        которые успели записать, пока сообщение отправлялось. None, если сводки нет.
+        """
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("UPDATE report_digests SET message_id = ? WHERE digest_id = ?", (message_id, digest_id))
+                row = db.execute(
+                    "SELECT chat_id, message_id, items FROM report_digests WHERE digest_id = ?", (digest_id,)
+                ).fetchone()
+        if row is None:
+            return None
+        return {"chat_id": row["chat_id"], "message_id": row["message_id"], "items": json.loads(row["items"])}
+
+    @traced("storage.reports.delete_digest")
+    def delete_digest(self, digest_id: str):
+        with self._lock:
+            self._db().execute("DELETE FROM report_digests WHERE digest_id = ?", (digest_id,))
+
+    def unsent_digests(self) -> list:
+        """ID сводок, которые были собраны, но не отправлены до остановки бота."""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT digest_id FROM report_digests WHERE message_id IS NULL ORDER BY created_at"
+            ).fetchall()
+        return [row["digest_id"] for row in rows]
+
+    def purge(self) -> int:
+        """Удаляет устаревшие отчёты и самые старые сверх лимита. Возвращает число удалённых."""
+        with self._lock:
+            db = self._db()
+            expired = db.execute(
+                "DELETE FROM pending_reports WHERE created_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            overflow = db.execute(
+                "DELETE FROM pending_reports WHERE report_key IN ("
+                "SELECT report_key FROM pending_reports ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_reports,),
+            ).rowcount
+            db.execute("DELETE FROM report_digests WHERE created_at < ?", (time.time() - self.ttl,))
+            db.execute("DELETE FROM report_decisions WHERE decided_at < ?", (time.time() - self.ttl,))
+            if overflow:
+                self._cache.clear()
+            else:
+                for report_key in [key for key, (_, created_at) in self._cache.items() if self._is_expired(created_at)]:
+                    del self._cache[report_key]
+            return expired + overflow
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+report_store = ReportStore()
+
+
+class HistoryStore:
+    """
+    История всех отчётов: кто, когда, что ремонтировал и что решил диспетчер.
+    Записи только добавляются (решение дописывается в ту же строку), выборки
+    идут по индексам bike_id, mechanic_id, location и дате, а для /stats
+    ведутся дневные агрегаты, чтобы не считать миллионы строк при каждом запросе.
+    Методы блокирующие: из обработчиков их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_database(self.path)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS report_history (
+                    id INTEGER PRIMARY KEY,
+                    report_key TEXT NOT NULL UNIQUE,
+                    bike_id TEXT NOT NULL,
+                    repair_type TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    works TEXT NOT NULL,
+                    mechanic_id INTEGER NOT NULL,
+                    mechanic_name TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    decision TEXT,
+                    dispatcher_name TEXT,
+                    decided_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_bike ON report_history (bike_id, created_at);
+                CREATE INDEX IF NOT EXISTS idx_history_mechanic ON report_history (mechanic_id, created_at);
+                CREATE INDEX IF NOT EXISTS idx_history_location ON report_history (location, created_at);
+                CREATE INDEX IF NOT EXISTS idx_history_day ON report_history (day);
+                CREATE TABLE IF NOT EXISTS report_stats_daily (
+                    day TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    mechanic_id INTEGER NOT NULL,
+                    submitted INTEGER NOT NULL DEFAULT 0,
+                    accepted INTEGER NOT NULL DEFAULT 0,
+                    declined INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, location, mechanic_id)
+                ) WITHOUT ROWID;
+                """
+            )
+        return self._conn
+
+    @traced("storage.history.record")
+    def record(self, report_key: str, report: dict) -> bool:
+        """
+        Добавляет отчёт в историю. Возвращает False, если отчёт с этим ключом уже записан.
+        В дневную статистику отчёт попадает после доставки, см. mark_delivered().
+        report: bike_id, repair_type, location, works, mechanic_id, mechanic_name.
+        """
+        now = time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        with self._lock:
+            cursor = self._db().execute(
+                "INSERT OR IGNORE INTO report_history (report_key, bike_id, repair_type, location, works, "
+                "mechanic_id, mechanic_name, day, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (report_key, report["bike_id"], report["repair_type"], report["location"],
+                 json.dumps(report["works"], ensure_ascii=False), report["mechanic_id"],
+                 report["mechanic_name"], day, now),
+            )
+            return cursor.rowcount == 1
+
+    @traced("storage.history.mark_delivered")
+    def mark_delivered(self, report_keys: list):
+        """Засчитывает доставленные диспетчерам отчёты в дневную статистику. Вызывается один раз на отчёт."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for report_key in report_keys:
+                    db.execute(
+                        "INSERT INTO report_stats_daily (day, location, mechanic_id, submitted) "
+                        "SELECT day, location, mechanic_id, 1 FROM report_history WHERE report_key = ? "
+                        "ON CONFLICT (day, location, mechanic_id) DO UPDATE SET submitted = submitted + 1",
+                        (report_key,),
+                    )
+
+    @traced("storage.history.decide")
+    def decide(self, report_key: str, decision: str, dispatcher_name: str = None):
+        """Записывает решение по отчёту: accepted, declined или undelivered."""
+        with self._lock:
+            db = self._db()
+            with db:
+                # Блокировка на запись берётся сразу: отложенная транзакция, начатая
+                # чтением, не может дождаться записи и сразу падает с «database is locked»
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute(
+                    "SELECT day, location, mechanic_id FROM report_history WHERE report_key = ? AND decision IS NULL",
+                    (report_key,),
+                ).fetchone()
+                if row is None:
+                    return
+                db.execute(
+                    "UPDATE report_history SET decision = ?, dispatcher_name = ?, decided_at = ? WHERE report_key = ?",
+                    (decision, dispatcher_name, time.time(), report_key),
+                )
+                if decision in ("accepted", "declined"):
+                    # Строки дня может ещё не быть, если решение пришло раньше, чем записалась доставка
+                    db.execute(
+                        f"INSERT INTO report_stats_daily (day, location, mechanic_id, {decision}) VALUES (?, ?, ?, 1) "
+                        f"ON CONFLICT (day, location, mechanic_id) DO UPDATE SET {decision} = {decision} + 1",
+                        (row["day"], row["location"], row["mechanic_id"]),
+                    )
+
+    def _rows(self, query: str, params) -> list:
+        with self._lock:
+            rows = self._db().execute(query, params).fetchall()
+        return [dict(row, works=json.loads(row["works"])) for row in rows]
+
+    @traced("storage.history.by_bike")
+    def by_bike(self, bike_id: str, limit: int = HISTORY_LIMIT) -> list:
+        """Последние ремонты велосипеда, от новых к старым."""
+        return self._rows(
+            "SELECT * FROM report_history WHERE bike_id = ? ORDER BY created_at DESC LIMIT ?", (bike_id, limit)
+        )
+
+    @traced("storage.history.recent")
+    def recent(self, since: float) -> list:
+        """Доставленные отчёты, созданные не раньше since, от старых к новым."""
+        return self._rows(
+            "SELECT report_key, bike_id, works, mechanic_name, created_at FROM report_history "
+            "WHERE day >= ? AND created_at >= ? AND (decision IS NULL OR decision != 'undelivered') "
+            "ORDER BY created_at",
+            (datetime.date.fromtimestamp(since).isoformat(), since),
+        )
+
+    @traced("storage.history.last_for_bike")
+    def last_for_bike(self, bike_id: str, since: float):
+        """Последний доставленный отчёт по велосипеду не раньше since или None."""
+        rows = self._rows(
+            "SELECT report_key, bike_id, works, mechanic_name, created_at FROM report_history "
+            "WHERE bike_id = ? AND created_at >= ? AND (decision IS NULL OR decision != 'undelivered') "
+            "ORDER BY created_at DESC LIMIT 1",
+            (bike_id, since),
+        )
+        return rows[0] if rows else None
+
+    @traced("storage.history.by_mechanic")
+    def by_mechanic(self, mechanic_id: int, limit: int = HISTORY_LIMIT) -> list:
+        """Последние отчёты механика, от новых к старым."""
+        return self._rows(
+            "SELECT * FROM report_history WHERE mechanic_id = ? ORDER BY created_at DESC LIMIT ?", (mechanic_id, limit)
+        )
+
+    def iter_range(self, first_day: datetime.date, last_day: datetime.date, location: str = None,
+                   chunk_size: int = EXPORT_CHUNK_SIZE):
+        """
+        Построчно отдаёт отчёты за период с first_day по last_day включительно.
+        Читает через отдельное соединение порциями по chunk_size строк,
+        поэтому не держит всю выборку в памяти и не блокирует остальные запросы.
+        """
+        if location:
+            since = datetime.datetime.combine(first_day, datetime.time.min).timestamp()
+            until = datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time.min).timestamp()
+            query = ("SELECT * FROM report_history WHERE location = ? AND created_at >= ? AND created_at < ? "
+                     "ORDER BY created_at")
+            params = (location, since, until)
+        else:
+            query = "SELECT * FROM report_history WHERE day >= ? AND day <= ? ORDER BY day, created_at"
+            params = (first_day.isoformat(), last_day.isoformat())
+
+        with self._lock:
+            self._db()
+        conn = open_database(self.path)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row, works=json.loads(row["works"]))
+        finally:
+            conn.close()
+
+    @traced("storage.history.stats")
+    def stats(self, since_day: str) -> dict:
+        """Сводная статистика начиная с since_day (YYYY-MM-DD) по дневным агрегатам."""
+        with self._lock:
+            db = self._db()
+            totals = db.execute(
+                "SELECT COALESCE(SUM(submitted), 0), COALESCE(SUM(accepted), 0), COALESCE(SUM(declined), 0) "
+                "FROM report_stats_daily WHERE day >= ?",
+                (since_day,),
+            ).fetchone()
+            locations = db.execute(
+                "SELECT location, SUM(submitted) AS total FROM report_stats_daily WHERE day >= ? "
+                "GROUP BY location ORDER BY total DESC",
+                (since_day,),
+            ).fetchall()
+            mechanics = db.execute(
+                "SELECT mechanic_id, SUM(submitted) AS total FROM report_stats_daily WHERE day >= ? "
+                "GROUP BY mechanic_id ORDER BY total DESC LIMIT 5",
+                (since_day,),
+            ).fetchall()
+        return {
+            "submitted": totals[0],
+            "accepted": totals[1],
+            "declined": totals[2],
+            "locations": [(row["location"], row["total"]) for row in locations],
+            "mechanics": [(row["mechanic_id"], row["total"]) for row in mechanics],
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+history_store = HistoryStore()
+
+
+class RecentRepairs:
+    """
+    Последний отчёт по каждому велосипеду за DUPLICATE_REPORT_WINDOW секунд:
+    ключ отчёта, работы, механик и время. Проверка на повторный отчёт -
+    один поиск в словаре. Записи старше окна вытесняются по очереди
+    в порядке добавления, а при запуске индекс восстанавливается из истории.
+    Обновления раздаются процессам по механику, а не по велосипеду, поэтому
+    с несколькими рабочими процессами (shared=True) lookup() ищет в общей
+    истории в базе по индексу bike_id.
+    """
+
+    def __init__(self, window: float = DUPLICATE_REPORT_WINDOW):
+        self.window = window
+        self.shared = False
+        self._by_bike = {}
+        self._order = deque()
+
+    def rebuild(self):
+        """Заполняет индекс отчётами из истории. Блокирующий: вызывается через asyncio.to_thread."""
+        records = history_store.recent(time.time() - self.window)
+        self._by_bike.clear()
+        self._order.clear()
+        for record in records:
+            self.add(record["bike_id"], record["report_key"], record["works"],
+                     record["mechanic_name"], record["created_at"])
+        logging.info(f"Recent repairs index rebuilt: {len(self._by_bike)} bikes")
+
+    def add(self, bike_id: str, report_key: str, works, mechanic_name: str, created_at: float = None):
+        created_at = time.time() if created_at is None else created_at
+        self._by_bike[bike_id] = {
+            "report_key": report_key,
+            "works": frozenset(works),
+            "mechanic_name": mechanic_name,
+            "created_at": created_at,
+        }
+        self._order.append((created_at, bike_id, report_key))
+        self._evict(time.time())
+
+    def discard(self, bike_id: str, report_key: str):
+        """Убирает отчёт, если он ещё последний по велосипеду (например, не доставлен)."""
+        entry = self._by_bike.get(bike_id)
+        if entry is not None and entry["report_key"] == report_key:
+            del self._by_bike[bike_id]
+
+    def get(self, bike_id: str):
+        """Последний отчёт по велосипеду в пределах окна или None."""
+        entry = self._by_bike.get(bike_id)
+        if entry is None or time.time() - entry["created_at"] > self.window:
+            return None
+        return entry
+
+    async def lookup(self, bike_id: str):
+        """Последний отчёт по велосипеду в пределах окна или None, с учётом других процессов."""
+        if not self.shared:
+            return self.get(bike_id)
+        record = await asyncio.to_thread(history_store.last_for_bike, bike_id, time.time() - self.window)
+        if record is None:
+            return None
+        return {
+            "report_key": record["report_key"],
+            "works": frozenset(record["works"]),
+            "mechanic_name": record["mechanic_name"],
+            "created_at": record["created_at"],
+        }
+
+    def _evict(self, now: float):
+        while self._order and now - self._order[0][0] > self.window:
+            _, bike_id, report_key = self._order.popleft()
+            self.discard(bike_id, report_key)
+
+    def __len__(self) -> int:
+        return len(self._by_bike)
+
+
+recent_repairs = RecentRepairs()
+
+
+def format_previous_repair(entry: dict, works=None) -> str:
+    """Строка о предыдущем отчёте по велосипеду; works - работы нового отчёта для сравнения."""
+    created = datetime.datetime.fromtimestamp(entry["created_at"]).strftime("%d.%m.%Y %H:%M")
+    text = f"{created}, механик {entry['mechanic_name']}: {'; '.join(sorted(entry['works']))}"
+    if works is not None:
+        same = entry["works"] & frozenset(works)
+        if same:
+            text += f"\nСовпадают работы: {'; '.join(sorted(same))}"
+    return text
+
+
+EXPORT_COLUMNS = ["Дата", "Велосипед", "Тип ремонта", "Локация", "Работы", "ID механика", "Механик",
+                  "Решение", "Диспетчер"]
+EXPORT_DECISIONS = {"accepted": "принят", "declined": "отклонён", "undelivered": "не доставлен"}
+
+
+def export_row(record: dict) -> list:
+    return [
+        datetime.datetime.fromtimestamp(record["created_at"]).strftime("%d.%m.%Y %H:%M"),
+        record["bike_id"],
+        record["repair_type"],
+        record["location"],
+        "; ".join(record["works"]),
+        record["mechanic_id"],
+        record["mechanic_name"],
+        EXPORT_DECISIONS.get(record["decision"], "ожидает решения"),
+        record["dispatcher_name"] or "",
+    ]
+
+
+def write_report_export(path: str, records, file_format: str = "csv") -> int:
+    """Потоково записывает отчёты в CSV или XLSX. Возвращает количество строк."""
+    count = 0
+    if file_format == "xlsx":
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Отчёты")
+        sheet.append(EXPORT_COLUMNS)
+        for record in records:
+            sheet.append(export_row(record))
+            count += 1
+        workbook.save(path)
+        return count
+
+    # utf-8-sig, чтобы Excel правильно открывал кириллицу
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(EXPORT_COLUMNS)
+        for record in records:
+            writer.writerow(export_row(record))
+            count += 1
+    return count
+
+
+async def purge_reports_periodically():
+    """Фоновая задача: периодически чистит устаревшие отчёты."""
+    while True:
+        try:
+            removed = await asyncio.to_thread(report_store.purge)
+            if removed:
+                logging.info(f"Purged {removed} stale pending reports")
+        except sqlite3.Error as e:
+            logging.error(f"Failed to purge pending reports: {e}")
+        await asyncio.sleep(REPORT_PURGE_INTERVAL)
+
+
+# --- Хранилище состояний FSM ---
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite с кэшем в памяти.
+    Чтение всегда идёт из памяти. Изменения помечают запись «грязной»,
+    и через FSM_FLUSH_DELAY все накопленные изменения записываются
+    одной транзакцией в фоновом потоке. При запуске restore() поднимает
+    незаконченные формы из базы.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE, flush_delay: float = FSM_FLUSH_DELAY):
+        self.path = path
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._records = {}
+        self._dirty = set()
+        self._scheduler = FlushScheduler(self.flush, flush_delay)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_database(self.path)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS fsm_records (
+                    storage_key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+        return self._conn
+
+    def restore(self) -> int:
+        """Загружает сохранённые формы в память. Возвращает их количество."""
+        with self._lock:
+            rows = self._db().execute("SELECT storage_key, state, data FROM fsm_records").fetchall()
+        for row in rows:
+            self._records[row["storage_key"]] = [row["state"], json.loads(row["data"])]
+        return len(rows)
+
+    def active_sessions(self) -> int:
+        """Количество пользователей с незаконченной формой."""
+        return sum(1 for state, _ in self._records.values() if state is not None)
+
+    def _record(self, key: StorageKey) -> list:
+        return self._records.get(self.key_builder.build(key), [None, {}])
+
+    def _store(self, key: StorageKey, state, data: dict):
+        if self._closed:
+            # Молча потерять изменение хуже, чем сорвать обработчик: всё отложенное
+            # должно быть записано до закрытия (см. stop_services)
+            raise RuntimeError("FSM storage is closed")
+        storage_key = self.key_builder.build(key)
+        if state is None and not data:
+            self._records.pop(storage_key, None)
+        else:
+            self._records[storage_key] = [state, data]
+        self._dirty.add(storage_key)
+        self._scheduler.schedule()
+
+    def _write(self, rows):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("BEGIN")
+                for storage_key, record in rows:
+                    if record is None:
+                        db.execute("DELETE FROM fsm_records WHERE storage_key = ?", (storage_key,))
+                    else:
+                        db.execute(
+                            "INSERT OR REPLACE INTO fsm_records (storage_key, state, data, updated_at) "
+                            "VALUES (?, ?, ?, ?)",
+                            (storage_key, record[0], record[1], now),
+                        )
+
+    async def flush(self):
+        """Записывает на диск все накопленные изменения."""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for storage_key in dirty:
+            record = self._records.get(storage_key)
+            if record is None:
+                rows.append((storage_key, None))
+            else:
+                rows.append((storage_key, (record[0], json.dumps(record[1], ensure_ascii=False))))
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to persist FSM state: {e}")
+            self._dirty |= dirty
+
+    @traced("storage.fsm.set_state")
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        self._store(key, state, self._record(key)[1])
+
+    @traced("storage.fsm.get_state")
+    async def get_state(self, key: StorageKey):
+        return self._record(key)[0]
+
+    @traced("storage.fsm.set_data")
+    async def set_data(self, key: StorageKey, data) -> None:
+        self._store(key, self._record(key)[0], dict(data))
+
+    @traced("storage.fsm.get_data")
+    async def get_data(self, key: StorageKey) -> dict:
+        return json.loads(json.dumps(self._record(key)[1]))
+
+    @traced("storage.fsm.update_data")
+    async def update_data(self, key: StorageKey, data) -> dict:
+        state, current_data = self._record(key)
+        current_data = {**current_data, **data}
+        self._store(key, state, current_data)
+        return json.loads(json.dumps(current_data))
+
+    async def close(self) -> None:
+        """Записывает накопленные изменения и закрывает базу; после этого запись запрещена."""
+        self._closed = True
+        await self._scheduler.close()
+        await self.flush()
+        if self._dirty:
+            logging.error(f"FSM storage closed with {len(self._dirty)} unsaved records")
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_fsm_storage(kind: str = None) -> BaseStorage:
+    """Создаёт хранилище FSM: kind или выбранное в настройках (FSM_STORAGE)."""
+    kind = kind or FSM_STORAGE
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "sqlite":
+        storage = SQLiteStorage()
+        restored = storage.restore()
+        logging.info(f"Restored {restored} FSM records from {storage.path}")
+        return storage
+    raise ValueError(f"Unknown FSM storage: {kind}")
+
+
+# --- Исходящая очередь сообщений ---
+class TokenBucket:
+    """Token bucket с резервированием: reserve() сразу возвращает, сколько ждать."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Запрещает отправку на seconds секунд (ответ 429 от Telegram)."""
+        self.updated_at = time.monotonic()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class OutboundJob:
+    __slots__ = ("chat_id", "make_call", "priority", "future", "created_at", "attempts", "reserved", "trace")
+
+    def __init__(self, chat_id, make_call, priority, future):
+        self.chat_id = chat_id
+        self.make_call = make_call
+        self.priority = priority
+        self.future = future
+        self.created_at = time.monotonic()
+        self.attempts = 0
+        self.reserved = False
+        # Трассировка обновления, из которого поставлен запрос
+        self.trace = current_trace.get()
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих запросов к Telegram.
+    Соблюдает лимиты на каждый чат и на бота в целом, повторяет запрос
+    после 429 через retry_after и отдаёт приоритет отчётам диспетчерам.
+    make_call - функция без аргументов, возвращающая корутину запроса,
+    чтобы запрос можно было повторить.
+    """
+
+    def __init__(self, workers: int = OUTBOX_WORKERS, global_rate: float = OUTBOX_GLOBAL_RATE,
+                 group_rate: float = OUTBOX_GROUP_RATE, private_rate: float = OUTBOX_PRIVATE_RATE,
+                 max_retries: int = OUTBOX_MAX_RETRIES):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets = {}
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._delayed = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=1000)
+
+    def share_limits(self, processes: int):
+        """Делит общие лимиты бота и групповых чатов между processes процессами."""
+        self._global_bucket = TokenBucket(self._global_bucket.rate / processes,
+                                          capacity=max(1.0, self._global_bucket.capacity / processes))
+        self.group_rate /= processes
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Ждёт отправки оставшихся сообщений (не дольше timeout) и останавливает обработчики."""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Outbound queue stopped with {self.depth()} undelivered messages")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id, make_call, priority: int = PRIORITY_MECHANIC) -> asyncio.Future:
+        """Ставит запрос в очередь и возвращает future с его результатом."""
+        future = asyncio.get_running_loop().create_future()
+        self._put(OutboundJob(chat_id, make_call, priority, future))
+        return future
+
+    async def deliver(self, chat_id, make_call, priority: int = PRIORITY_MECHANIC):
+        """Ставит запрос в очередь и ждёт его выполнения."""
+        return await self.submit(chat_id, make_call, priority)
+
+    def _put(self, job: OutboundJob):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def _put_later(self, delay: float, job: OutboundJob):
+        self._delayed += 1
+
+        def put():
+            self._delayed -= 1
+            self._put(job)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if int(chat_id) < 0 else self.private_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: OutboundJob):
+        if job.future.done():
+            return
+        if not job.reserved:
+            # Чат ещё не готов: откладываем задачу и берём следующую
+            wait = self._chat_bucket(job.chat_id).reserve()
+            if wait > 0:
+                job.reserved = True
+                self._put_later(wait, job)
+                return
+        job.reserved = False
+
+        wait = self._global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        job.attempts += 1
+        token = current_trace.set(job.trace)
+        try:
+            result = await job.make_call()
+        except TelegramRetryAfter as e:
+            self._retry(job, e, e.retry_after, pause_chat=True)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(job, e, min(2 ** job.attempts, 60))
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            current_trace.reset(token)
+
+    def _retry(self, job: OutboundJob, error: Exception, delay: float, pause_chat: bool = False):
+        if job.attempts > self.max_retries:
+            self._finish(job, error=error)
+            return
+        self.retries += 1
+        logging.warning(f"Retrying message to chat {job.chat_id} in {delay}s (attempt {job.attempts}): {error}")
+        if pause_chat:
+            # Пауза в ведре чата сама отложит эту и следующие отправки в этот чат
+            self._chat_bucket(job.chat_id).pause(delay)
+            self._put(job)
+        else:
+            self._put_later(delay, job)
+
+    def _finish(self, job: OutboundJob, result=None, error: Exception = None):
+        self.latencies.append(time.monotonic() - job.created_at)
+        if job.future.done():
+            return
+        if error is None:
+            self.sent += 1
+            job.future.set_result(result)
+        else:
+            self.failed += 1
+            job.future.set_exception(error)
+
+    def depth(self) -> int:
+        """Количество сообщений, ожидающих отправки."""
+        return (self._queue.qsize() if self._queue is not None else 0) + self._delayed
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            "depth": self.depth(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+        }
+
+
+outbox = OutboundQueue()
+
+
+# --- Сводки отчётов для диспетчеров ---
+def render_digest(items: list, line_limit: int = None):
+    """
+    Собирает текст и клавиатуру сводки. Отчёты сгруппированы по локациям.
+    Если текст не влезает в сообщение, строки отчётов укорачиваются поровну.
+    """
+    by_location = {}
+    for item in items:
+        by_location.setdefault(item["location"], []).append(item)
+
+    lines = [f"📋 Сводка отчётов ({len(items)})"]
+    builder = InlineKeyboardBuilder()
+    number = 0
+    for location, location_items in by_location.items():
+        lines.append(f"\n📍 {location}")
+        for item in location_items:
+            number += 1
+            line = item["line"]
+            if line_limit is not None and len(line) > line_limit:
+                line = line[:line_limit - 1] + "…"
+            lines.append(f"{number}. {line}")
+            if item["status"]:
+                lines.append(f"   {item['status']}")
+            else:
+                builder.row(
+                    types.InlineKeyboardButton(text=f"✅ {number}. {item['bike_id']}", callback_data=f"accept_{item['key']}"),
+                    types.InlineKeyboardButton(text=f"❌ {number}. {item['bike_id']}", callback_data=f"decline_{item['key']}"),
+                )
+    text = "\n".join(lines)
+    if len(text) > TELEGRAM_MESSAGE_LIMIT and line_limit is None:
+        fixed = len(text) - sum(len(item["line"]) for item in items)
+        return render_digest(items, line_limit=max((TELEGRAM_MESSAGE_LIMIT - fixed) // len(items), 1))
+    return text, builder.as_markup()
+
+
+class DigestBuffer:
+    """
+    Копит отчёты для чата диспетчеров и отправляет их одной сводкой.
+    Собираемая сводка сразу сохраняется в базе, поэтому после перезапуска
+    restore() досылает то, что не успело уйти.
+    """
+
+    def __init__(self, window: float = DIGEST_WINDOW, max_reports: int = DIGEST_MAX_REPORTS):
+        self.window = window
+        self.max_reports = max_reports
+        self.bot = None
+        self._open = {}
+        self._timers = {}
+        self._lock = KeyedLocks()
+
+    async def restore(self, bot: Bot):
+        self.bot = bot
+        for digest_id in await asyncio.to_thread(report_store.unsent_digests):
+            asyncio.create_task(self.flush(digest_id))
+
+    async def add(self, bot: Bot, chat_id: int, item: dict):
+        """Добавляет отчёт в открытую сводку чата. item: key, bike_id, mechanic_id, location, line."""
+        self.bot = bot
+        while True:
+            digest_id = self._open.get(chat_id)
+            if digest_id is None:
+                digest_id = self._open[chat_id] = str(uuid.uuid4())[:8]
+                self._timers[digest_id] = asyncio.get_running_loop().call_later(
+                    self.window, lambda digest_id=digest_id: asyncio.ensure_future(self.flush(digest_id))
+                )
+            async with self._lock(digest_id):
+                # Пока ждали блокировку, сводку могли отправить: тогда открываем новую
+                if self._open.get(chat_id) != digest_id:
+                    continue
+                digest = await asyncio.to_thread(report_store.get_digest, digest_id) or {
+                    "chat_id": chat_id, "message_id": None, "items": [],
+                }
+                if digest["message_id"] is not None:
+                    del self._open[chat_id]
+                    continue
+                digest["items"].append({**item, "status": None})
+                await asyncio.to_thread(report_store.save_digest, digest_id, digest)
+                report_data = await asyncio.to_thread(report_store.get, item["key"])
+                if report_data is not None:
+                    await asyncio.to_thread(report_store.put, item["key"], {**report_data, "digest_id": digest_id})
+                full = len(digest["items"]) >= self.max_reports
+                if full:
+                    # Следующие отчёты пойдут уже в новую сводку
+                    del self._open[chat_id]
+                break
+        if full:
+            await self.flush(digest_id)
+        return digest_id
+
+    async def flush(self, digest_id: str):
+        """Отправляет сводку в чат диспетчеров."""
+        timer = self._timers.pop(digest_id, None)
+        if timer is not None:
+            timer.cancel()
+        async with self._lock(digest_id):
+            digest = await asyncio.to_thread(report_store.get_digest, digest_id)
+            if digest is None or digest["message_id"] is not None:
+                return
+            if self._open.get(digest["chat_id"]) == digest_id:
+                del self._open[digest["chat_id"]]
+
+            text, markup = render_digest(digest["items"])
+            try:
+                message = await outbox.deliver(
+                    digest["chat_id"],
+                    functools.partial(self.bot.send_message, chat_id=digest["chat_id"], text=text, reply_markup=markup),
+                    PRIORITY_DISPATCHER,
+                )
+            except Exception as e:
+                logging.error(f"Failed to deliver digest {digest_id}: {e}")
+                await asyncio.to_thread(report_store.delete_digest, digest_id)
+                for item in digest["items"]:
+                    await report_delivery_failed(self.bot, item["mechanic_id"], item["bike_id"], item["key"], e)
+                return
+            # Диспетчер мог нажать кнопку сразу после отправки: такие решения уже
+            # записаны в базе, но не попали в сообщение, поэтому дорисовываем их
+            sent = await asyncio.to_thread(report_store.mark_digest_sent, digest_id, message.message_id)
+            await asyncio.to_thread(history_store.mark_delivered, [item["key"] for item in digest["items"]])
+            if sent is not None and sent["items"] != digest["items"]:
+                try:
+                    await self._edit(sent)
+                except Exception as e:
+                    logging.error(f"Failed to update digest {digest_id}: {e}")
+
+    async def resolve(self, digest_id: str, report_key: str, status: str):
+        """Отмечает решение по одному отчёту и обновляет только его строку в сводке."""
+        digest = await asyncio.to_thread(report_store.resolve_digest_item, digest_id, report_key, status)
+        if digest is None:
+            return None
+        if all(item["status"] for item in digest["items"]):
+            self._lock.discard(digest_id)
+        if digest["message_id"] is None:
+            # Сводка ещё отправляется: решение покажет flush после отправки
+            return None
+        return self._edit(digest)
+
+    def _edit(self, digest: dict) -> asyncio.Future:
+        text, markup = render_digest(digest["items"])
+        return outbox.submit(
+            digest["chat_id"],
+            functools.partial(
+                self.bot.edit_message_text,
+                chat_id=digest["chat_id"],
+                message_id=digest["message_id"],
+                text=text,
+                reply_markup=markup,
+            ),
+            PRIORITY_DISPATCHER,
+        )
+
+    async def close(self):
+        """Отправляет все собираемые сводки."""
+        for digest_id in list(self._open.values()):
+            await self.flush(digest_id)
+
+
+digest_buffer = DigestBuffer()
+
+
+# --- Правка сообщений с кнопками без лишних запросов ---
+# Сколько последних сообщений помнить; старые вытесняются первыми
+RENDERED_MESSAGES_CACHE_SIZE = 10000
+
+
+def markup_fingerprint(markup) -> tuple:
+    """Кнопки клавиатуры в виде кортежа, пригодного для сравнения и хэширования."""
+    if markup is None:
+        return ()
+    return tuple(
+        tuple((button.text, button.callback_data, button.url) for button in row)
+        for row in markup.inline_keyboard
+    )
+
+
+class RenderedMessages:
+    """
+    Хэши последнего текста и клавиатуры, отправленных в сообщение, по (чат, сообщение).
+    По ним edit_callback_message пропускает правки, которые ничего не меняют,
+    и отправляет только клавиатуру, если текст остался прежним. Для сообщений,
+    которых нет в кэше, используется содержимое сообщения из нажатия.
+    Правки в обход edit_callback_message записывает RenderedMessagesMiddleware,
+    поэтому кэш не расходится с тем, что видит пользователь.
+    """
+
+    def __init__(self, max_size: int = RENDERED_MESSAGES_CACHE_SIZE):
+        self.max_size = max_size
+        self._rendered = OrderedDict()
+        self.skipped = 0
+        self.markup_only = 0
+
+    def get(self, message) -> tuple:
+        """(хэш текста, хэш клавиатуры) сообщения; None, если неизвестно."""
+        rendered = self._rendered.get((message.chat.id, message.message_id))
+        if rendered is not None:
+            return rendered
+        text = getattr(message, "text", None)
+        if text is None:
+            return None, None
+        return hash(text), hash(markup_fingerprint(getattr(message, "reply_markup", None)))
+
+    def remember(self, chat_id: int, message_id: int, text_hash, markup_hash):
+        key = (chat_id, message_id)
+        self._rendered[key] = (text_hash, markup_hash)
+        self._rendered.move_to_end(key)
+        while len(self._rendered) > self.max_size:
+            self._rendered.popitem(last=False)
+
+    def remember_markup(self, chat_id: int, message_id: int, markup_hash):
+        """Новая клавиатура при прежнем тексте (если текст известен)."""
+        text_hash, _ = self._rendered.get((chat_id, message_id), (None, None))
+        self.remember(chat_id, message_id, text_hash, markup_hash)
+
+    def forget(self, chat_id: int, message_id: int):
+        self._rendered.pop((chat_id, message_id), None)
+
+
+rendered_messages = RenderedMessages()
+
+
+class RenderedMessagesMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot API: записывает в rendered_messages каждую успешную правку сообщения."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        result = await make_request(bot, method)
+        name = method.__api_method__
+        if name in ("editMessageText", "editMessageReplyMarkup") and method.message_id is not None:
+            chat_id = method.chat_id
+            markup_hash = hash(markup_fingerprint(method.reply_markup))
+            if name == "editMessageText":
+                rendered_messages.remember(chat_id, method.message_id, hash(method.text), markup_hash)
+            else:
+                rendered_messages.remember_markup(chat_id, method.message_id, markup_hash)
+        return result
+
+
+async def send_edit(message, edit):
+    """Выполняет правку; при ошибке забывает сообщение, «message is not modified» не считается ошибкой."""
+    try:
+        await edit
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            rendered_messages.forget(message.chat.id, message.message_id)
+            raise
+    except Exception:
+        rendered_messages.forget(message.chat.id, message.message_id)
+        raise
+
+
+async def edit_callback_message(callback_query: types.CallbackQuery, text: str = None, reply_markup=None,
+                                answer: bool = True):
+    """
+    Правит сообщение, в котором нажата кнопка, и одновременно отвечает на нажатие.
+    Если текст и клавиатура не изменились, запрос к Telegram не отправляется;
+    если изменилась только клавиатура, отправляется editMessageReplyMarkup.
+    text=None оставляет текст сообщения прежним; answer=False - если на нажатие уже ответили.
+    """
+    message = callback_query.message
+    text_hash, markup_hash = rendered_messages.get(message)
+    new_text_hash = text_hash if text is None else hash(text)
+    new_markup_hash = hash(markup_fingerprint(reply_markup))
+
+    if text is not None and new_text_hash != text_hash:
+        edit = message.edit_text(text, reply_markup=reply_markup)
+    elif new_markup_hash != markup_hash:
+        edit = message.edit_reply_markup(reply_markup=reply_markup)
+        rendered_messages.markup_only += 1
+    else:
+        rendered_messages.skipped += 1
+        if answer:
+            await callback_query.answer()
+        return
+
+    # Запоминаем до отправки, чтобы повторное нажатие во время запроса уже считалось повтором
+    rendered_messages.remember(message.chat.id, message.message_id, new_text_hash, new_markup_hash)
+    if answer:
+        await asyncio.gather(send_edit(message, edit), asyncio.ensure_future(callback_query.answer()))
+    else:
+        await send_edit(message, edit)
+
+
+# --- Отметка работ с задержкой ---
+class WorkToggles:
+    """
+    Собирает нажатия механика на работы.
+    Каждое нажатие сразу применяется к списку в памяти под блокировкой
+    пользователя, поэтому быстрые нажатия не теряются и идут по порядку.
+    Клавиатура и состояние формы обновляются одним запросом и одной записью,
+    когда механик WORK_TOGGLE_DEBOUNCE секунд не нажимал кнопки. Перед любым
+    другим действием пользователя WorkTogglesMiddleware сохраняет нажатия сразу.
+    """
+
+    def __init__(self, debounce: float = WORK_TOGGLE_DEBOUNCE):
+        self.debounce = debounce
+        self._pending = {}
+        self._timers = {}
+        self._lock = KeyedLocks()
+
+    async def toggle(self, callback_query: types.CallbackQuery, state: FSMContext, work_name: str):
+        """Отмечает или снимает работу и откладывает обновление клавиатуры."""
+        user_id = callback_query.from_user.id
+        async with self._lock(user_id):
+            pending = self._pending.get(user_id)
+            if pending is None:
+                user_data = await state.get_data()
+                pending = self._pending[user_id] = {
+                    "state": state,
+                    "category": user_data.get("current_category"),
+                    "selected_works": list(user_data.get("selected_works", [])),
+                }
+            selected_works = pending["selected_works"]
+            if work_name in selected_works:
+                selected_works.remove(work_name)
+            else:
+                selected_works.append(work_name)
+            pending["callback_query"] = callback_query
+
+            timer = self._timers.pop(user_id, None)
+            if timer is not None:
+                timer.cancel()
+            if self.debounce > 0:
+                self._timers[user_id] = asyncio.get_running_loop().call_later(
+                    self.debounce, lambda: asyncio.ensure_future(self.flush_logged(user_id))
+                )
+        if self.debounce > 0:
+            await callback_query.answer()
+        else:
+            await self.flush(user_id, answer=True)
+
+    def is_pending(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    async def flush(self, user_id: int, answer: bool = False):
+        """Сохраняет отметки пользователя и обновляет клавиатуру."""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        async with self._lock(user_id):
+            pending = self._pending.pop(user_id, None)
+            if pending is None:
+                return
+            selected_works = pending["selected_works"]
+            await pending["state"].update_data(selected_works=selected_works)
+        # Правка идёт уже без блокировки, чтобы новые нажатия не ждали ответа Telegram
+        await edit_callback_message(
+            pending["callback_query"],
+            reply_markup=get_category_works_keyboard(pending["category"], selected_works),
+            answer=answer,
+        )
+
+    async def flush_logged(self, user_id: int):
+        """Как flush, но ошибку только пишет в лог, чтобы не сорвать следующее действие пользователя."""
+        try:
+            await self.flush(user_id)
+        except Exception as e:
+            logging.error(f"Failed to apply work toggles for user {user_id}: {e}")
+
+    async def close(self):
+        """Сохраняет все отложенные отметки."""
+        for user_id in list(self._pending):
+            await self.flush_logged(user_id)
+
+
+work_toggles = WorkToggles()
+
+
+class WorkTogglesMiddleware(BaseMiddleware):
+    """Внутренний middleware: сохраняет отложенные отметки работ до того, как их прочитает другой обработчик."""
+
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        if (user is not None and work_toggles.is_pending(user.id)
+                and data["handler"].callback is not process_works_selection):
+            await work_toggles.flush_logged(user.id)
+        return await handler(event, data)
 
 
 # --- Список выполняемых работ, сгруппированных по категориям ---
-REPAIR_CATEGORIES = {
+# Каталог по умолчанию: им заполняется база при первом запуске.
+# Дальше каталог и локации читаются из базы (таблицы categories, works,
+# category_works и locations) и подхватываются без перезапуска.
+DEFAULT_REPAIR_CATEGORIES = {
     "🛠️ Частый ремонт": [
         "🛞 Переднее колесо", "🩹 Камера", "⚙️ Мотор колесо", "⚙️ Звезда задняя",
         "⚙️ Передний подшипник", "🛑 Колодки (задние)", "🛑 Колодки (передние)",
@@ -158,21 +2191,330 @@ REPAIR_CATEGORIES = {
     ]
 }
 
-# Список фиксированных локаций для отчётов, укажите свои списки ремонтных точек
-LOCATIONS = ["Пример1", "Пример2"]
+# Формат номера велосипеда, например AB123C
+BIKE_ID_PATTERN = re.compile(r"[A-Z]{2}\d{3}[A-Z]")
+
+# Список фиксированных локаций для отчётов, укажите свои списки ремонтных точек
+DEFAULT_LOCATIONS = ["Пример1", "Пример2"]
+
+# Файл каталога для команды /reload_catalog: JSON или YAML (.yaml/.yml, нужен PyYAML).
+# Главный источник каталога — база: файл выгружается из неё при запуске, если его нет,
+# и при каждом изменении каталога в базе, поэтому /reload_catalog не откатит чужие правки.
+CATALOG_FILE = "catalog.json"
+
+# Переименованные работы: старое название -> новое.
+# Ключи кнопок зависят только от названия, поэтому при переименовании
+# добавьте сюда старое название, чтобы уже открытые у механиков клавиатуры
+# продолжили работать.
+WORK_RENAMES = {}
+
+
+def make_callback_key(name: str) -> str:
+    """
+    Возвращает короткий стабильный ключ для callback_data.
+    Ключ зависит только от названия, поэтому одинаков после перезапуска,
+    в любом процессе бота и не меняется при перестановке пунктов каталога.
+    """
+    return hashlib.blake2b(name.encode("utf-8"), digest_size=5).hexdigest()
+
+
+def build_callback_index(names, renames=None):
+    """Строит прямой (название -> ключ) и обратный (ключ -> название) индексы."""
+    forward = {}
+    reverse = {}
+    for name in names:
+        if name in forward:
+            continue
+        key = make_callback_key(name)
+        if key in reverse:
+            raise ValueError(f"Callback key collision: {reverse[key]!r} and {name!r}")
+        forward[name] = key
+        reverse[key] = name
+    for old_name, new_name in (renames or {}).items():
+        if new_name in forward:
+            reverse.setdefault(make_callback_key(old_name), new_name)
+    return forward, reverse
+
+
+def get_catalog_version(categories) -> str:
+    """Версия каталога работ: меняется при любом изменении каталога."""
+    raw = json.dumps(categories, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=4).hexdigest()
+
+
+# Эмодзи и служебные символы, из которых они собираются
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U00002600-\U000027BF"  # Unicode range for dingbats and symbols
+    "\U0001F600-\U0001F64F"  # Emoticons
+    "\U0001F300-\U0001F5FF"  # Transport & Map Symbols
+    "\U0001F680-\U0001F6FF"  # Miscellaneous Symbols and Pictographs
+    "\U0001F700-\U0001F77F"  # Geometric Shapes Extended
+    "\U0001F780-\U0001F7FF"  # Alchemical Symbols
+    "\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
+    "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+    "\U0001FA00-\U0001FA6F"  # Chess Symbols
+    "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+    "\U00002702-\U000027B0"  # Dingbats
+    "\U000024C2-\U0001F251"  # Enclosed symbols
+    "\U00002B50"             # White medium star
+    "\U0001F1E6-\U0001F1FF"  # Regional Indicator Symbols
+    # Из блоков стрелок и технических символов - только эмодзи, чтобы
+    # не вырезать «→» или «⌀» из названий работ, введённых вручную
+    "\U00002194-\U00002199\U000021A9-\U000021AA"  # Arrows: ↔️ ↕️ ↖️ ↗️ ↘️ ↙️ ↩️ ↪️
+    "\U0000231A-\U0000231B\U00002328\U000023CF"  # Miscellaneous Technical: ⌚ ⌛ ⌨️ ⏏️
+    "\U000023E9-\U000023F3\U000023F8-\U000023FA"  # ⏩ ... ⏳, ⏸️ ⏹️ ⏺️
+    "\U0000200D"             # Zero Width Joiner
+    "\U000020E3"             # Combining Enclosing Keycap
+    "\U0000FE00-\U0000FE0F"  # Variation Selectors
+    "\U000E0020-\U000E007F"  # Tags
+    "]+",
+    flags=re.UNICODE,
+)
+
+def remove_emojis_and_strip(text: str) -> str:
+    """
+    Удаляет все эмодзи из строки
+    """
+    return EMOJI_PATTERN.sub("", text).strip()
+
+
+# Размер LRU-кэша клавиатур работ (категория + набор отмеченных работ)
+WORK_KEYBOARD_CACHE_SIZE = 1024
+# Ограничение Telegram на длину callback_data в байтах
+CALLBACK_DATA_LIMIT = 64
+
+
+# Поиск работ через inline-режим: сколько результатов показывать,
+# какая доля триграмм запроса должна совпасть и сколько запросов держать в кэше
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_MIN_SIMILARITY = 0.5
+SEARCH_CACHE_SIZE = 2048
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def search_words(text: str) -> list:
+    """Слова названия без эмодзи, в нижнем регистре и с «е» вместо «ё»."""
+    return WORD_PATTERN.findall(remove_emojis_and_strip(text).lower().replace("ё", "е"))
+
+
+def word_trigrams(words) -> set:
+    grams = set()
+    for word in words:
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class WorkSearchIndex:
+    """
+    Индекс для поиска работ по очищенным названиям.
+    Сначала идут работы, у которых каждое слово запроса - начало слова
+    в названии («кол пер» -> «Колодки (передние)»), затем похожие по
+    триграммам, чтобы находились названия с опечатками. Результаты
+    запросов кэшируются, поэтому при наборе запроса по буквам повторный
+    поиск почти ничего не стоит.
+    """
+
+    def __init__(self, works):
+        self.works = tuple(works)
+        self._prefixes = {}
+        self._trigrams = {}
+        for index, work in enumerate(self.works):
+            words = search_words(work)
+            for word in words:
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(index)
+            for gram in word_trigrams(words):
+                self._trigrams.setdefault(gram, set()).add(index)
+        self.search = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._search)
+
+    def _search(self, query: str) -> tuple:
+        """Названия работ, подходящих под запрос, от лучших к худшим."""
+        words = search_words(query)
+        if not words:
+            return self.works[:SEARCH_RESULTS_LIMIT]
+
+        prefix_matches = set(self._prefixes.get(words[0], ()))
+        for word in words[1:]:
+            prefix_matches &= self._prefixes.get(word, set())
+
+        # У слишком коротких запросов почти все триграммы - края слов,
+        # поэтому для них учитываются только совпадения по началу слов
+        grams = word_trigrams(words)
+        shared = {}
+        for gram in grams:
+            for index in self._trigrams.get(gram, ()):
+                shared[index] = shared.get(index, 0) + 1
+
+        scores = {}
+        for index, count in shared.items():
+            similarity = count / len(grams)
+            if index in prefix_matches:
+                scores[index] = 1 + similarity
+            elif similarity >= SEARCH_MIN_SIMILARITY and len(grams) > 2:
+                scores[index] = similarity
+        ranked = sorted(scores, key=lambda index: (-scores[index], index))
+        return tuple(self.works[index] for index in ranked[:SEARCH_RESULTS_LIMIT])
+
+
+class Catalog:
+    """
+    Снимок каталога: работы по категориям, локации, индексы ключей кнопок,
+    названия для диспетчеров и готовые клавиатуры. После создания не
+    меняется. Новый каталог собирается целиком (в том числе в фоновом
+    потоке) и подменяет старый одним присваиванием в apply_catalog(),
+    поэтому обработчики не видят наполовину собранный каталог.
+    """
+
+    def __init__(self, categories: dict, locations: list, renames: dict = None):
+        if not categories:
+            raise ValueError("в каталоге нет категорий")
+        if not locations:
+            raise ValueError("в каталоге нет локаций")
+        for category, works in categories.items():
+            if not isinstance(category, str) or not isinstance(works, (list, tuple)) or not works:
+                raise ValueError(f"категория {category!r} должна содержать непустой список работ")
+            for work in works:
+                if not isinstance(work, str) or not work.strip():
+                    raise ValueError(f"в категории {category!r} есть пустое название работы")
+        for location in locations:
+            if not isinstance(location, str) or len(f"loc_{location}".encode("utf-8")) > CALLBACK_DATA_LIMIT:
+                raise ValueError(f"недопустимое название локации {location!r}")
+
+        # Повторы внутри категории убираются; работа из нескольких категорий получает один ключ
+        self.categories = {name: tuple(dict.fromkeys(works)) for name, works in categories.items()}
+        self.locations = tuple(dict.fromkeys(locations))
+        self.version = get_catalog_version({"categories": self.categories, "locations": self.locations})
+
+        self.reverse_category_callbacks = {
+            name: f"cat_{key}" for name, key in build_callback_index(self.categories)[0].items()
+        }
+        self.category_callbacks = {key: name for name, key in self.reverse_category_callbacks.items()}
+        self.work_callbacks, self.reverse_work_callbacks = build_callback_index(
+            (work_name for works_list in self.categories.values() for work_name in works_list),
+            renames,
+        )
+        # Множества работ каждой категории для быстрой проверки принадлежности
+        self.category_work_sets = {name: frozenset(works) for name, works in self.categories.items()}
+        # Названия работ без эмодзи для отчётов диспетчерам
+        self.dispatcher_work_names = {work: remove_emojis_and_strip(work) for work in self.work_callbacks}
+        # Категории каждой работы и готовые результаты для inline-поиска
+        self.work_categories = {}
+        for name, works in self.categories.items():
+            for work in works:
+                self.work_categories.setdefault(work, []).append(name)
+        self.search_index = WorkSearchIndex(self.work_callbacks)
+        self.inline_results = {
+            work: types.InlineQueryResultArticle(
+                id=key,
+                title=work,
+                description=", ".join(self.work_categories[work]),
+                input_message_content=types.InputTextMessageContent(message_text=work),
+            )
+            for work, key in self.work_callbacks.items()
+        }
+
+        self.locations_keyboard = self._build_locations_keyboard()
+        self.categories_keyboard = self._build_categories_keyboard()
+        self._works_keyboards = functools.lru_cache(maxsize=WORK_KEYBOARD_CACHE_SIZE)(self.build_works_keyboard)
+        for category in self.categories:
+            self._works_keyboards(category, frozenset())
+
+    def works_count(self) -> int:
+        return len(self.work_callbacks)
+
+    def to_dict(self) -> dict:
+        return {
+            "locations": list(self.locations),
+            "categories": {name: list(works) for name, works in self.categories.items()},
+        }
+
+    def _build_locations_keyboard(self):
+        """Создает клавиатуру для выбора фиксированных локаций."""
+        builder = InlineKeyboardBuilder()
+        for loc in self.locations:
+            builder.add(types.InlineKeyboardButton(text=loc, callback_data=f"loc_{loc}"))
+        builder.adjust(2)
+        builder.row(
+            types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
+        )
+        return builder.as_markup()
+
+    def _build_categories_keyboard(self):
+        builder = InlineKeyboardBuilder()
+        for key, name in self.category_callbacks.items():
+            builder.add(types.InlineKeyboardButton(text=name, callback_data=f"category_{key}"))
+        builder.adjust(2)
+        builder.row(
+            types.InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm")
+        )
+        builder.row(
+            types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
+        )
+        return builder.as_markup()
+
+    def works_keyboard(self, category: str, selected_works):
+        """
+        Возвращает клавиатуру работ категории.
+        В ключ кэша входят только отмеченные работы этой категории,
+        поэтому повторные состояния при переключении не пересобираются.
+        """
+        category_works = self.category_work_sets.get(category, frozenset())
+        return self._works_keyboards(category, category_works.intersection(selected_works))
+
+    def build_works_keyboard(self, category: str, selected_works: frozenset):
+        builder = InlineKeyboardBuilder()
+        works_list = self.categories.get(category, ())
+        for work in works_list:
+            button_text = f"✅ {work}" if work in selected_works else work
+            work_key = self.work_callbacks.get(work)
+            if work_key:
+                builder.add(types.InlineKeyboardButton(text=button_text, callback_data=f"work_{work_key}"))
+
+        builder.adjust(2)
+        builder.row(
+            types.InlineKeyboardButton(text="↩️ Назад к категориям", callback_data="back_to_categories")
+        )
+        builder.row(
+            types.InlineKeyboardButton(text="✏️ Добавить вручную", callback_data="add_custom")
+        )
+        return builder.as_markup()
+
+
+def read_catalog_file(path: str = CATALOG_FILE) -> Catalog:
+    """
+    Читает каталог из файла вида {"locations": [...], "categories": {категория: [работы]}}
+    и собирает по нему Catalog. При ошибке в файле выбрасывает ValueError.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("для каталога в YAML установите PyYAML: pip install pyyaml")
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(str(e))
+        else:
+            data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("categories"), dict):
+        raise ValueError("файл должен содержать словарь categories и список locations")
+    return Catalog(data["categories"], data.get("locations") or [], WORK_RENAMES)
+
+
+def write_catalog_file(catalog: Catalog, path: str = CATALOG_FILE):
+    """Выгружает каталог в файл, чтобы его было удобно править. Файл подменяется целиком."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")) and yaml is not None:
+            yaml.safe_dump(catalog.to_dict(), f, allow_unicode=True, sort_keys=False)
+        else:
+            json.dump(catalog.to_dict(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
 
-# Создаем сопоставление коротких ключей и полных имен категорий
-CATEGORY_CALLBACKS = {f"cat_{i+1}": name for i, name in enumerate(REPAIR_CATEGORIES.keys())}
-REVERSE_CATEGORY_CALLBACKS = {name: key for key, name in CATEGORY_CALLBACKS.items()}
 
-# Создаём сопоставление коротких ключей для каждой работы
-WORK_CALLBACKS = {}
-REVERSE_WORK_CALLBACKS = {}
-for category_name, works_list in REPAIR_CATEGORIES.items():
-    for work_name in works_list:
-        work_key = str(uuid.uuid4())[:8]
-        WORK_CALLBACKS[work_name] = work_key
-        REVERSE_WORK_CALLBACKS[work_key] = work_name
+# Каталог, с которым работают обработчики. Подменяется только целиком, см. apply_catalog()
+catalog = Catalog(DEFAULT_REPAIR_CATEGORIES, DEFAULT_LOCATIONS, WORK_RENAMES)
 
 
 # --- Состояния для FSM (Finite State Machine) ---
@@ -194,11 +2536,23 @@ class AdminForm(StatesGroup):
     add_admin = State()
     remove_admin = State()
     set_dispatcher_id = State()
+    export = State()
 
 # Создаем главный роутер для обработки событий.
 router = Router()
 
 # --- Функции-помощники для создания клавиатур ---
+# Клавиатуры без параметров собираются один раз и дальше берутся из кэша.
+# Разметка aiogram неизменяема, поэтому один объект безопасно отдавать всем.
+@functools.cache
+def get_cancel_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
+    )
+    return builder.as_markup()
+
+@functools.cache
 def get_repair_type_keyboard():
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -211,47 +2565,15 @@ def get_repair_type_keyboard():
     return builder.as_markup()
 
 def get_locations_keyboard():
-    """Создает клавиатуру для выбора фиксированных локаций."""
-    builder = InlineKeyboardBuilder()
-    for loc in LOCATIONS:
-        builder.add(types.InlineKeyboardButton(text=loc, callback_data=f"loc_{loc}"))
-    builder.adjust(2)
-    builder.row(
-        types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
-    )
-    return builder.as_markup()
+    return catalog.locations_keyboard
 
 def get_categories_keyboard():
-    builder = InlineKeyboardBuilder()
-    for key, name in CATEGORY_CALLBACKS.items():
-        builder.add(types.InlineKeyboardButton(text=name, callback_data=f"category_{key}"))
-    builder.adjust(2)
-    builder.row(
-        types.InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm")
-    )
-    builder.row(
-        types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
-    )
-    return builder.as_markup()
+    return catalog.categories_keyboard
 
 def get_category_works_keyboard(category: str, selected_works: list):
-    builder = InlineKeyboardBuilder()
-    works_list = REPAIR_CATEGORIES.get(category, [])
-    for work in works_list:
-        button_text = f"✅ {work}" if work in selected_works else work
-        work_key = WORK_CALLBACKS.get(work)
-        if work_key:
-            builder.add(types.InlineKeyboardButton(text=button_text, callback_data=f"work_{work_key}"))
-
-    builder.adjust(2)
-    builder.row(
-        types.InlineKeyboardButton(text="↩️ Назад к категориям", callback_data="back_to_categories")
-    )
-    builder.row(
-        types.InlineKeyboardButton(text="✏️ Добавить вручную", callback_data="add_custom")
-    )
-    return builder.as_markup()
+    return catalog.works_keyboard(category, selected_works)
 
+@functools.cache
 def get_final_confirmation_keyboard():
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -260,6 +2582,7 @@ def get_final_confirmation_keyboard():
     )
     return builder.as_markup()
 
+@functools.cache
 def get_start_over_keyboard():
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -275,6 +2598,7 @@ def get_dispatcher_keyboard(report_key: str):
     )
     return builder.as_markup()
 
+@functools.cache
 def get_admin_menu_keyboard():
     """Клавиатура для админ-панели."""
     builder = InlineKeyboardBuilder()
@@ -293,12 +2617,23 @@ def get_admin_menu_keyboard():
     builder.row(
         types.InlineKeyboardButton(text="⚙️ Настроить ID чата диспетчера", callback_data="admin_set_dispatcher_id")
     )
+    builder.row(
+        types.InlineKeyboardButton(text="📤 Экспорт отчётов", callback_data="admin_export")
+    )
     builder.row(
         types.InlineKeyboardButton(text="↩️ Выйти", callback_data="admin_exit")
     )
-    builder.adjust(2, 2, 2, 1, 1)
+    builder.adjust(2, 2, 2, 1, 1, 1)
     return builder.as_markup()
 
+def warm_keyboard_cache():
+    """Заранее собирает статические клавиатуры, чтобы первый запрос их не строил."""
+    get_cancel_keyboard()
+    get_repair_type_keyboard()
+    get_final_confirmation_keyboard()
+    get_start_over_keyboard()
+    get_admin_menu_keyboard()
+
 
 # --- Обработчики команд и сообщений ---
 @router.message(CommandStart())
@@ -314,9 +2649,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     await message.answer(
         "Привет! 👋 Чтобы начать, введи номер велосипеда (ID):",
-        reply_markup=InlineKeyboardBuilder().row(
-            types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
-        ).as_markup(),
+        reply_markup=get_cancel_keyboard(),
     )
     await state.set_state(Form.get_bike_id)
 
@@ -332,6 +2665,108 @@ async def cmd_myid(message: types.Message):
     await message.answer(f"Твой Telegram ID: `{user_id}`", parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@router.message(Command("history"))
+async def cmd_history(message: types.Message, command: CommandObject):
+    """
+    Обработчик команды /history <ID велосипеда>.
+    Показывает последние ремонты велосипеда.
+    """
+    if not is_authorized(message.from_user.id):
+        await message.answer("У вас нет прав для использования этого бота. Обратитесь к администратору.")
+        return
+
+    bike_id = (command.args or "").strip().upper()
+    if not BIKE_ID_PATTERN.fullmatch(bike_id):
+        await message.answer("Укажите номер велосипеда, например: /history AB123C")
+        return
+
+    records = await asyncio.to_thread(history_store.by_bike, bike_id)
+    if not records:
+        await message.answer(f"По велосипеду {bike_id} ремонтов не найдено.")
+        return
+
+    decisions = {"accepted": "✅ принят", "declined": "❌ отклонён", "undelivered": "⚠️ не доставлен"}
+    lines = [f"🕑 Последние ремонты велосипеда {bike_id}:"]
+    for record in records:
+        created = datetime.datetime.fromtimestamp(record["created_at"]).strftime("%d.%m.%Y %H:%M")
+        decision = decisions.get(record["decision"], "🕓 ожидает решения")
+        if record["dispatcher_name"]:
+            decision = f"{decision} ({record['dispatcher_name']})"
+        lines.append(
+            f"\n{created} · {record['location']} · {record['repair_type']}\n"
+            f"Работы: {'; '.join(record['works'])}\n"
+            f"Механик: {record['mechanic_name']} · {decision}"
+        )
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    """
+    Обработчик команды /stats.
+    Показывает статистику отчётов для администраторов.
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    today = datetime.date.today()
+    since = (today - datetime.timedelta(days=STATS_DAYS - 1)).isoformat()
+    today_stats = await asyncio.to_thread(history_store.stats, today.isoformat())
+    period_stats = await asyncio.to_thread(history_store.stats, since)
+
+    lines = [
+        "📊 Статистика отчётов",
+        f"\nСегодня: отправлено {today_stats['submitted']}, принято {today_stats['accepted']}, "
+        f"отклонено {today_stats['declined']}",
+        f"За {STATS_DAYS} дней: отправлено {period_stats['submitted']}, принято {period_stats['accepted']}, "
+        f"отклонено {period_stats['declined']}",
+    ]
+    if period_stats["locations"]:
+        lines.append("\nПо локациям:")
+        lines.extend(f"- {location}: {total}" for location, total in period_stats["locations"])
+    if period_stats["mechanics"]:
+        lines.append("\nБольше всего отчётов:")
+        lines.extend(f"- {mechanic_id}: {total}" for mechanic_id, total in period_stats["mechanics"])
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("reload_catalog"))
+async def cmd_reload_catalog(message: types.Message):
+    """
+    Обработчик команды /reload_catalog.
+    Загружает каталог работ и локации из CATALOG_FILE без перезапуска бота.
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    try:
+        # Каталог со всеми индексами и клавиатурами собирается в фоновом потоке
+        new_catalog = await asyncio.to_thread(read_catalog_file, CATALOG_FILE)
+    except FileNotFoundError:
+        await message.answer(f"❌ Файл каталога {CATALOG_FILE} не найден.")
+        return
+    except (OSError, ValueError) as e:
+        await message.answer(f"❌ Каталог не загружен: {e}\nБот продолжает работать с прежним каталогом.")
+        return
+
+    try:
+        # Запись в базу подхватят остальные процессы бота
+        await asyncio.to_thread(directory.save_catalog, new_catalog.to_dict()["categories"], list(new_catalog.locations))
+    except sqlite3.Error as e:
+        logging.error(f"Failed to save catalog: {e}")
+        await message.answer(f"❌ Каталог не сохранён: {e}\nБот продолжает работать с прежним каталогом.")
+        return
+    if apply_catalog(new_catalog):
+        await message.answer(
+            f"✅ Каталог обновлён (версия {new_catalog.version}): {len(new_catalog.categories)} категорий, "
+            f"{new_catalog.works_count()} работ, {len(new_catalog.locations)} локаций."
+        )
+    else:
+        await message.answer(f"Каталог не изменился (версия {new_catalog.version}).")
+
+
 @router.message(Form.get_bike_id, F.text)
 async def process_bike_id(message: types.Message, state: FSMContext):
     """
@@ -344,9 +2779,8 @@ async def process_bike_id(message: types.Message, state: FSMContext):
         return
 
     bike_id = message.text.upper()
-    pattern = r"^[A-Z]{2}\d{3}[A-Z]$"
     
-    if re.fullmatch(pattern, bike_id):
+    if BIKE_ID_PATTERN.fullmatch(bike_id):
         await state.update_data(bike_id=bike_id)
         await message.answer(
             f"Номер велосипеда: {bike_id}\n\nТеперь выбери тип ремонта:",
@@ -356,9 +2790,7 @@ async def process_bike_id(message: types.Message, state: FSMContext):
     else:
         await message.answer(
             "❌ Неверный формат. Пример: AB123C",
-            reply_markup=InlineKeyboardBuilder().row(
-                types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
-            ).as_markup(),
+            reply_markup=get_cancel_keyboard(),
         )
         await state.set_state(Form.get_bike_id)
 
@@ -395,7 +2827,7 @@ async def process_location_selection(callback_query: types.CallbackQuery, state:
 @router.callback_query(Form.select_category, F.data.startswith("category_"))
 async def process_category_selection(callback_query: types.CallbackQuery, state: FSMContext):
     category_key = callback_query.data.split("_", 1)[1]
-    category = CATEGORY_CALLBACKS.get(category_key)
+    category = catalog.category_callbacks.get(category_key)
     
     if not category:
         await callback_query.answer("Категория не найдена. Попробуйте еще раз.", show_alert=True)
@@ -406,35 +2838,78 @@ async def process_category_selection(callback_query: types.CallbackQuery, state:
     
     await state.update_data(current_category=category)
     
-    await callback_query.message.edit_text(
+    await edit_callback_message(
+        callback_query,
         f"Категория: {category}\n\nВыбери выполненные работы:",
         reply_markup=get_category_works_keyboard(category, selected_works),
     )
-    await callback_query.answer()
     await state.set_state(Form.select_works)
 
 
 @router.callback_query(Form.select_works, F.data.startswith("work_"))
 async def process_works_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    user_data = await state.get_data()
-    current_category = user_data.get("current_category")
-    selected_works = user_data.get("selected_works", [])
-    
     work_key = callback_query.data.split("_", 1)[1]
-    work_name = REVERSE_WORK_CALLBACKS.get(work_key)
+    work_name = catalog.reverse_work_callbacks.get(work_key)
 
     if not work_name:
         await callback_query.answer("Работа не найдена. Попробуйте еще раз.", show_alert=True)
         return
 
+    await work_toggles.toggle(callback_query, state, work_name)
+
+
+@router.inline_query()
+async def inline_search_works(inline_query: types.InlineQuery, state: FSMContext):
+    """
+    Inline-поиск работ: механик набирает «@бот колод» и выбирает работу.
+    Выбранный результат отправляется в чат названием работы, и
+    process_inline_work отмечает её в форме.
+    """
+    if not is_authorized(inline_query.from_user.id):
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
+
+    current_catalog = catalog
+    works = current_catalog.search_index.search(inline_query.query)
+    selected_works = set((await state.get_data()).get("selected_works", []))
+    results = [
+        current_catalog.inline_results[work].model_copy(update={"title": f"✅ {work}"})
+        if work in selected_works else current_catalog.inline_results[work]
+        for work in works
+    ]
+    button = None
+    if await state.get_state() not in (Form.select_category.state, Form.select_works.state):
+        button = types.InlineQueryResultsButton(text="Сначала начните отчёт", start_parameter="start")
+    await inline_query.answer(results, cache_time=0, is_personal=True, button=button)
+
+
+@router.message(StateFilter(Form.select_category, Form.select_works), F.via_bot, F.text)
+async def process_inline_work(message: types.Message, state: FSMContext, bot: Bot):
+    """Отмечает или снимает работу, выбранную через inline-поиск."""
+    if message.via_bot.id != bot.id or message.text not in catalog.work_callbacks:
+        await message.answer("Работа не найдена. Выберите её кнопками или через поиск.")
+        return
+
+    work_name = message.text
+    user_data = await state.get_data()
+    selected_works = user_data.get("selected_works", [])
     if work_name in selected_works:
         selected_works.remove(work_name)
+        action = "Убрана работа"
     else:
         selected_works.append(work_name)
-
+        action = "Добавлена работа"
     await state.update_data(selected_works=selected_works)
-    await callback_query.message.edit_reply_markup(reply_markup=get_category_works_keyboard(current_category, selected_works))
-    await callback_query.answer()
+
+    current_category = user_data.get("current_category")
+    if await state.get_state() == Form.select_works.state and current_category in catalog.categories:
+        reply_markup = get_category_works_keyboard(current_category, selected_works)
+    else:
+        reply_markup = get_categories_keyboard()
+    await message.answer(
+        f"{action}: {work_name}\nОтмечено работ: {len(selected_works)}",
+        reply_markup=reply_markup,
+    )
 
 
 @router.callback_query(Form.select_works, F.data == "back_to_categories")
@@ -442,11 +2917,11 @@ async def back_to_categories(callback_query: types.CallbackQuery, state: FSMCont
     user_data = await state.get_data()
     repair_type = user_data.get("repair_type")
     
-    await callback_query.message.edit_text(
+    await edit_callback_message(
+        callback_query,
         f"Тип ремонта: {repair_type}\n\nВыбери следующую категорию:",
         reply_markup=get_categories_keyboard(),
     )
-    await callback_query.answer()
     await state.set_state(Form.select_category)
 
 
@@ -468,6 +2943,8 @@ async def process_custom_work(message: types.Message, state: FSMContext):
     selected_works = user_data.get("selected_works", [])
     custom_work = message.text
     selected_works.append(custom_work)
+    # Сразу очищаем название, чтобы при отправке отчёта оно было в кэше
+    get_dispatcher_work_name(custom_work)
     await state.update_data(selected_works=selected_works)
     await message.answer(
         f"Работа '{custom_work}' добавлена. Выбери следующую категорию или заверши отчёт:",
@@ -490,6 +2967,18 @@ async def cancel_custom_add(callback_query: types.CallbackQuery, state: FSMConte
     await state.set_state(Form.select_works)
 
 
+def format_repair_summary(bike_id: str, repair_type: str, location: str, selected_works: list) -> str:
+    """Текст сводки, которую механик подтверждает перед отправкой."""
+    works_list = "\n- ".join(selected_works)
+    return (
+        f"Сводка по ремонту\n\n"
+        f"Велосипед № {bike_id}\n"
+        f"Тип ремонта: {repair_type}\n"
+        f"Локация: {location}\n"
+        f"Выполненные работы:\n- {works_list}\n"
+    )
+
+
 @router.callback_query(F.data == "confirm", StateFilter(Form.select_works, Form.select_category))
 async def confirm_works(callback_query: types.CallbackQuery, state: FSMContext):
     user_data = await state.get_data()
@@ -502,19 +2991,16 @@ async def confirm_works(callback_query: types.CallbackQuery, state: FSMContext):
         await callback_query.answer("Пожалуйста, выбери хотя бы одну выполненную работу.", show_alert=True)
         return
 
-    works_list = "\n- ".join(selected_works)
-    summary = (
-        f"Сводка по ремонту\n\n"
-        f"Велосипед № {bike_id}\n"
-        f"Тип ремонта: {repair_type}\n"
-        f"Локация: {location}\n"
-        f"Выполненные работы:\n- {works_list}\n"
-    )
-
-    await callback_query.message.edit_text(
-        summary,
-        reply_markup=get_final_confirmation_keyboard(),
-    )
+    summary = format_repair_summary(bike_id, repair_type, location, selected_works)
+    previous = await recent_repairs.lookup(bike_id)
+    if previous is not None:
+        dispatcher_works = [get_dispatcher_work_name(work) for work in selected_works]
+        summary += (
+            f"\n⚠️ По этому велосипеду уже отправлялся отчёт:\n"
+            f"{format_previous_repair(previous, dispatcher_works)}\n"
+            f"Убедись, что это не повторная отправка.\n"
+        )
+    await callback_query.message.edit_text(summary, reply_markup=get_final_confirmation_keyboard())
     await callback_query.answer()
     await state.set_state(Form.confirm)
 
@@ -525,30 +3011,28 @@ def format_telegram_link(user: types.User) -> str:
     else:
         return f"[{user.first_name}](tg://user?id={user.id})"
 
-def remove_emojis_and_strip(text: str) -> str:
-    """
-    Удаляет все эмодзи из строки
-    """
-    emoji_pattern = re.compile(
-        "["
-        "\U00002600-\U000027BF"  # Unicode range for dingbats and symbols
-        "\U0001F600-\U0001F64F"  # Emoticons
-        "\U0001F300-\U0001F5FF"  # Transport & Map Symbols
-        "\U0001F680-\U0001F6FF"  # Miscellaneous Symbols and Pictographs
-        "\U0001F700-\U0001F77F"  # Geometric Shapes Extended
-        "\U0001F780-\U0001F7FF"  # Alchemical Symbols
-        "\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
-        "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-        "\U0001FA00-\U0001FA6F"  # Chess Symbols
-        "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-        "\U00002702-\U000027B0"  # Dingbats
-        "\U000024C2-\U0001F251"  # Enclosed symbols
-        "\U00002B50"             # White medium star
-        "\U0001F1E6-\U0001F1FF"  # Regional Indicator Symbols
-        "]+",
-        flags=re.UNICODE,
-    )
-    return emoji_pattern.sub("", text).strip()
+# Сколько очищенных названий работ, добавленных вручную, держать в кэше
+CUSTOM_WORK_NAME_CACHE_SIZE = 512
+
+@functools.lru_cache(maxsize=CUSTOM_WORK_NAME_CACHE_SIZE)
+def _clean_custom_work_name(work: str) -> str:
+    return remove_emojis_and_strip(work)
+
+def get_dispatcher_work_name(work: str) -> str:
+    """Название работы для диспетчера: из таблицы каталога или из кэша ручных работ."""
+    name = catalog.dispatcher_work_names.get(work)
+    return name if name is not None else _clean_custom_work_name(work)
+
+def format_dispatcher_report(bike_id: str, repair_type: str, location: str, works_list: str, mechanic_link: str) -> str:
+    """Текст отчёта для чата диспетчеров."""
+    return (
+        f"Велосипед № {bike_id}\n"
+        f"Тип ремонта: {repair_type}\n"
+        f"Локация: {location}\n"
+        f"Статус: готов\n"
+        f"Выполненные работы: {works_list}\n"
+        f"ID механика: {mechanic_link}"
+    )
 
 
 @router.callback_query(Form.confirm, F.data == "final_confirm")
@@ -569,113 +3053,263 @@ async def send_report(callback_query: types.CallbackQuery, state: FSMContext, bo
     mechanic = callback_query.from_user
 
     # Удаляем эмодзи из названий работ перед отправкой диспетчеру
-    dispatcher_works = [remove_emojis_and_strip(work) for work in selected_works]
+    dispatcher_works = [get_dispatcher_work_name(work) for work in selected_works]
     works_list = "; ".join(dispatcher_works)
-    
-    report_message = (
-        f"Велосипед № {bike_id}\n"
-        f"Тип ремонта: {repair_type}\n"
-        f"Локация: {location}\n"
-        f"Статус: готов\n"
-        f"Выполненные работы: {works_list}\n"
-        f"ID механика: {format_telegram_link(mechanic)}"
-    )
+    report_message = format_dispatcher_report(bike_id, repair_type, location, works_list, format_telegram_link(mechanic))
+    previous = await recent_repairs.lookup(bike_id)
+    if previous is not None:
+        report_message += f"\n\n⚠️ Предыдущий ремонт: {format_previous_repair(previous, dispatcher_works)}"
 
     report_key = str(uuid.uuid4())[:8]
-    pending_reports[report_key] = {
+    await asyncio.to_thread(report_store.put, report_key, {
         "bike_id": bike_id,
         "mechanic_id": mechanic.id
-    }
+    })
+    recorded = await asyncio.to_thread(history_store.record, report_key, {
+        "bike_id": bike_id,
+        "repair_type": repair_type,
+        "location": location,
+        "works": dispatcher_works,
+        "mechanic_id": mechanic.id,
+        "mechanic_name": format_telegram_link(mechanic),
+    })
+    recent_repairs.add(bike_id, report_key, dispatcher_works, format_telegram_link(mechanic))
 
-    try:
-        await bot.send_message(
+    if DIGEST_MODE:
+        try:
+            await digest_buffer.add(bot, dispatcher_chat_id, {
+                "key": report_key,
+                "bike_id": bike_id,
+                "mechanic_id": mechanic.id,
+                "location": location,
+                "line": f"Велосипед № {bike_id}, {repair_type}: {works_list}. Механик: {format_telegram_link(mechanic)}"
+                        + (" ⚠️ повторный отчёт" if previous is not None else ""),
+            })
+            await callback_query.message.edit_text(
+                "✅ Отчёт добавлен в сводку для диспетчеров и скоро будет отправлен.",
+                reply_markup=get_start_over_keyboard(),
+            )
+        finally:
+            await state.clear()
+            await callback_query.answer()
+        return
+
+    delivery = outbox.submit(
+        dispatcher_chat_id,
+        functools.partial(
+            bot.send_message,
             chat_id=dispatcher_chat_id,
             text=report_message,
-            reply_markup=get_dispatcher_keyboard(report_key)
-        )
+            reply_markup=get_dispatcher_keyboard(report_key),
+        ),
+        PRIORITY_DISPATCHER,
+    )
+    try:
+        await asyncio.wait_for(asyncio.shield(delivery), OUTBOX_REPLY_TIMEOUT)
+        if recorded:
+            await asyncio.to_thread(history_store.mark_delivered, [report_key])
         await callback_query.message.edit_text(
             "✅ Отчёт успешно отправлен диспетчерам. Они скоро его обработают.",
             reply_markup=get_start_over_keyboard(),
         )
+    except asyncio.TimeoutError:
+        # Очередь перегружена: отчёт уйдёт позже, механику сообщим, если не получится
+        delivery.add_done_callback(
+            lambda future: asyncio.ensure_future(
+                report_delivery_done(future, bot, mechanic.id, bike_id, report_key, recorded)
+            )
+        )
+        await callback_query.message.edit_text(
+            "🕓 Отчёт поставлен в очередь и будет отправлен диспетчерам в ближайшее время.",
+            reply_markup=get_start_over_keyboard(),
+        )
     except Exception as e:
         await callback_query.message.edit_text(
             f"❌ Ошибка отправки отчёта: {str(e)}.",
             reply_markup=get_start_over_keyboard(),
         )
-        if report_key in pending_reports:
-            del pending_reports[report_key]
+        recent_repairs.discard(bike_id, report_key)
+        await asyncio.to_thread(report_store.delete, report_key)
+        await asyncio.to_thread(history_store.decide, report_key, "undelivered")
     finally:
         await state.clear()
         await callback_query.answer()
 
 
-@router.callback_query(F.data.startswith("accept_"))
-async def accept_report(callback_query: types.CallbackQuery, bot: Bot):
-    try:
-        report_key = callback_query.data.split("_", 1)[1]
-        report_data = pending_reports.get(report_key)
-        
-        if not report_data:
-            await callback_query.answer("Данные по отчёту не найдены. Возможно, они устарели.", show_alert=True)
-            return
+async def report_delivery_done(delivery: asyncio.Future, bot: Bot, mechanic_id: int, bike_id: str, report_key: str,
+                               recorded: bool = True):
+    """Засчитывает доставленный отложенный отчёт или сообщает механику, что его не удалось доставить."""
+    if delivery.cancelled():
+        return
+    if delivery.exception() is None:
+        if recorded:
+            await asyncio.to_thread(history_store.mark_delivered, [report_key])
+        return
+    logging.error(f"Failed to deliver report {report_key}: {delivery.exception()}")
+    await report_delivery_failed(bot, mechanic_id, bike_id, report_key, delivery.exception())
 
-        mechanic_id = report_data["mechanic_id"]
-        bike_id = report_data["bike_id"]
 
-    except Exception:
-        await callback_query.answer("Ошибка в данных. Попробуйте еще раз.", show_alert=True)
-        return
-        
-    await callback_query.message.edit_text(
-        f"{callback_query.message.text}\n\n✅ Отчёт принят диспетчером {callback_query.from_user.first_name}.",
+async def report_delivery_failed(bot: Bot, mechanic_id: int, bike_id: str, report_key: str, error: Exception):
+    """Удаляет недоставленный отчёт и просит механика отправить его заново."""
+    recent_repairs.discard(bike_id, report_key)
+    await asyncio.to_thread(report_store.delete, report_key)
+    await asyncio.to_thread(history_store.decide, report_key, "undelivered")
+    outbox.submit(
+        mechanic_id,
+        functools.partial(
+            bot.send_message,
+            chat_id=mechanic_id,
+            text=f"❌ Не удалось отправить отчёт о ремонте велосипеда №{bike_id}: {error}. Пожалуйста, отправьте его заново.",
+        ),
+        PRIORITY_MECHANIC,
     )
-    
+
+
+def log_delivery_failure(description: str, delivery: asyncio.Future):
+    if not delivery.cancelled() and delivery.exception() is not None:
+        logging.error(f"Failed to {description}: {delivery.exception()}")
+
+
+# Сколько последних ID нажатий помнить для отсева повторных доставок
+SEEN_CALLBACKS_LIMIT = 10000
+
+
+class DuplicateCallbackMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: пропускает нажатия, которые уже обрабатывались.
+    Telegram повторяет обновление, если вебхук не ответил вовремя, и без
+    этой проверки повторная доставка приняла бы отчёт или отметила работу дважды.
+    Обновления одного пользователя всегда попадают в один процесс, поэтому
+    достаточно помнить ID в памяти.
+    """
+
+    def __init__(self, limit: int = SEEN_CALLBACKS_LIMIT):
+        self.limit = limit
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    async def __call__(self, handler, event: types.CallbackQuery, data: dict):
+        if event.id in self._seen:
+            self.duplicates += 1
+            logging.info(f"Skipped duplicate callback query {event.id} from user {event.from_user.id}")
+            return None
+        self._seen[event.id] = None
+        while len(self._seen) > self.limit:
+            self._seen.popitem(last=False)
+        return await handler(event, data)
+
+
+DECISION_NAMES = {"accepted": "принят", "declined": "отклонён"}
+
+
+async def claim_report(callback_query: types.CallbackQuery, decision: str):
+    """
+    Забирает отчёт из кнопки для решения decision.
+    Возвращает (ключ, данные отчёта) или None, если решение уже принято
+    или отчёта нет; в этом случае на нажатие уже ответили.
+    """
+    report_key = callback_query.data.split("_", 1)[1]
     try:
-        await bot.send_message(
-            chat_id=mechanic_id,
-            text=f"🎉 Отчёт о ремонте велосипеда №{bike_id} принят диспетчером.",
+        report_data, previous = await asyncio.to_thread(
+            report_store.claim, report_key, decision, callback_query.from_user.first_name
         )
-    except Exception as e:
-        logging.error(f"Failed to send notification to mechanic {mechanic_id}: {e}")
-    
-    if report_key in pending_reports:
-        del pending_reports[report_key]
-        
-    await callback_query.answer("Отчёт принят. Механик уведомлён.")
+    except sqlite3.Error as e:
+        logging.error(f"Failed to claim report {report_key}: {e}")
+        await callback_query.answer("Ошибка в данных. Попробуйте еще раз.", show_alert=True)
+        return None
 
+    if previous is not None:
+        await callback_query.answer(
+            f"Отчёт уже {DECISION_NAMES.get(previous['decision'], 'обработан')} "
+            f"диспетчером {previous['dispatcher_name']}.",
+            show_alert=True,
+        )
+        return None
+    if not report_data:
+        await callback_query.answer("Данные по отчёту не найдены. Возможно, они устарели.", show_alert=True)
+        return None
+    return report_key, report_data
 
-@router.callback_query(F.data.startswith("decline_"))
-async def decline_report(callback_query: types.CallbackQuery, bot: Bot):
-    try:
-        report_key = callback_query.data.split("_", 1)[1]
-        report_data = pending_reports.get(report_key)
-        
-        if not report_data:
-            await callback_query.answer("Данные по отчёту не найдены. Возможно, они устарели.", show_alert=True)
-            return
 
-        mechanic_id = report_data["mechanic_id"]
-        bike_id = report_data["bike_id"]
-        
-    except Exception:
-        await callback_query.answer("Ошибка в данных. Попробуйте еще раз.", show_alert=True)
+@router.callback_query(F.data.startswith("accept_"))
+async def accept_report(callback_query: types.CallbackQuery, bot: Bot):
+    claimed = await claim_report(callback_query, "accepted")
+    if claimed is None:
         return
-    
-    await callback_query.message.edit_text(
-        f"{callback_query.message.text}\n\n❌ Отчёт отклонён диспетчером {callback_query.from_user.first_name}.",
+    report_key, report_data = claimed
+    mechanic_id = report_data["mechanic_id"]
+    bike_id = report_data["bike_id"]
+
+    if report_data.get("digest_id"):
+        edit = await digest_buffer.resolve(
+            report_data["digest_id"], report_key, f"✅ принят ({callback_query.from_user.first_name})"
+        )
+    else:
+        edit = outbox.submit(
+            callback_query.message.chat.id,
+            functools.partial(
+                callback_query.message.edit_text,
+                f"{callback_query.message.text}\n\n✅ Отчёт принят диспетчером {callback_query.from_user.first_name}.",
+            ),
+            PRIORITY_DISPATCHER,
+        )
+    if edit is not None:
+        edit.add_done_callback(functools.partial(log_delivery_failure, f"update dispatcher message for report {report_key}"))
+
+    notification = outbox.submit(
+        mechanic_id,
+        functools.partial(
+            bot.send_message,
+            chat_id=mechanic_id,
+            text=f"🎉 Отчёт о ремонте велосипеда №{bike_id} принят диспетчером.",
+        ),
+        PRIORITY_MECHANIC,
     )
+    notification.add_done_callback(functools.partial(log_delivery_failure, f"send notification to mechanic {mechanic_id}"))
     
-    try:
-        await bot.send_message(
+    await asyncio.to_thread(history_store.decide, report_key, "accepted", callback_query.from_user.first_name)
+
+    await callback_query.answer("Отчёт принят. Механик уведомлён.")
+
+
+@router.callback_query(F.data.startswith("decline_"))
+async def decline_report(callback_query: types.CallbackQuery, bot: Bot):
+    claimed = await claim_report(callback_query, "declined")
+    if claimed is None:
+        return
+    report_key, report_data = claimed
+    mechanic_id = report_data["mechanic_id"]
+    bike_id = report_data["bike_id"]
+
+    if report_data.get("digest_id"):
+        edit = await digest_buffer.resolve(
+            report_data["digest_id"], report_key, f"❌ отклонён ({callback_query.from_user.first_name})"
+        )
+    else:
+        edit = outbox.submit(
+            callback_query.message.chat.id,
+            functools.partial(
+                callback_query.message.edit_text,
+                f"{callback_query.message.text}\n\n❌ Отчёт отклонён диспетчером {callback_query.from_user.first_name}.",
+            ),
+            PRIORITY_DISPATCHER,
+        )
+    if edit is not None:
+        edit.add_done_callback(functools.partial(log_delivery_failure, f"update dispatcher message for report {report_key}"))
+
+    notification = outbox.submit(
+        mechanic_id,
+        functools.partial(
+            bot.send_message,
             chat_id=mechanic_id,
             text=f"😞 Отчёт о ремонте велосипеда №{bike_id} отклонён диспетчером. Пожалуйста, проверьте отчёт.",
-        )
-    except Exception as e:
-        logging.error(f"Failed to send notification to mechanic {mechanic_id}: {e}")
+        ),
+        PRIORITY_MECHANIC,
+    )
+    notification.add_done_callback(functools.partial(log_delivery_failure, f"send notification to mechanic {mechanic_id}"))
     
-    if report_key in pending_reports:
-        del pending_reports[report_key]
-        
+    await asyncio.to_thread(history_store.decide, report_key, "declined", callback_query.from_user.first_name)
+
     await callback_query.answer("Отчёт отклонён. Механик уведомлён.")
 
 
@@ -694,9 +3328,7 @@ async def restart_form(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.message.edit_reply_markup(reply_markup=None)
     await callback_query.message.answer(
         "Привет! 👋 Чтобы начать, введи номер велосипеда (ID):",
-        reply_markup=InlineKeyboardBuilder().row(
-            types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
-        ).as_markup(),
+        reply_markup=get_cancel_keyboard(),
     )
     await state.set_state(Form.get_bike_id)
     await callback_query.answer()
@@ -721,70 +3353,148 @@ async def cmd_admin(message: types.Message, state: FSMContext):
     await message.answer("Добро пожаловать в админ-панель!", reply_markup=get_admin_menu_keyboard())
 
 
+# --- Добавление и удаление пользователей списком ---
+# Максимальный размер файла со списком ID, байт
+ROLE_UPLOAD_LIMIT = 256 * 1024
+# Сколько ID каждой группы показывать в итоговом сообщении
+ROLE_SUMMARY_LIMIT = 30
+USER_IDS_SEPARATOR = re.compile(r"[\s,;]+")
+# Заголовки первой колонки CSV, которые пропускаются; любая другая нечисловая
+# первая строка попадает в некорректные записи
+USER_IDS_CSV_HEADERS = frozenset({"id", "user_id", "userid", "telegram_id", "tg_id", "chat_id", "айди"})
+USER_IDS_HINT = (
+    "Можно отправить несколько ID через пробел, запятую или с новой строки "
+    "либо загрузить CSV или текстовый файл со списком."
+)
+# Заголовки итогового сообщения: (изменены, уже были в нужном состоянии)
+ROLE_BATCH_TITLES = {
+    (ROLE_MECHANIC, True): ("Добавлены механики", "Уже были механиками"),
+    (ROLE_MECHANIC, False): ("Удалены из механиков", "Не были механиками"),
+    (ROLE_ADMIN, True): ("Добавлены администраторы", "Уже были администраторами"),
+    (ROLE_ADMIN, False): ("Удалены из администраторов", "Не были администраторами"),
+}
+
+
+def parse_user_ids(text: str) -> tuple:
+    """Разбирает список ID. Возвращает (корректные ID без повторов, некорректные записи)."""
+    valid, invalid = {}, {}
+    for token in USER_IDS_SEPARATOR.split(text):
+        if token:
+            (valid if token.isdigit() else invalid)[token] = None
+    return list(valid), list(invalid)
+
+
+async def read_user_ids(message: types.Message, bot: Bot) -> tuple:
+    """
+    ID из текста сообщения или из приложенного файла.
+    В CSV берётся первая колонка; первая строка пропускается, только если
+    это заголовок из USER_IDS_CSV_HEADERS.
+    Бросает ValueError, если файл слишком большой или не в UTF-8.
+    """
+    document = message.document
+    if document is None:
+        return parse_user_ids(message.text)
+    if document.file_size and document.file_size > ROLE_UPLOAD_LIMIT:
+        raise ValueError(f"файл больше {ROLE_UPLOAD_LIMIT // 1024} КБ")
+
+    content = await bot.download(document)
+    try:
+        text = content.read().decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("файл должен быть в кодировке UTF-8")
+    if (document.file_name or "").lower().endswith(".csv"):
+        column = [row[0].strip() for row in csv.reader(text.splitlines()) if row and row[0].strip()]
+        if column and re.sub(r"[\s-]+", "_", column[0].lower()) in USER_IDS_CSV_HEADERS:
+            column = column[1:]
+        text = "\n".join(column)
+    return parse_user_ids(text)
+
+
+def format_id_group(title: str, user_ids: list) -> str:
+    shown = ", ".join(user_ids[:ROLE_SUMMARY_LIMIT])
+    if len(user_ids) > ROLE_SUMMARY_LIMIT:
+        shown += f" и ещё {len(user_ids) - ROLE_SUMMARY_LIMIT}"
+    return f"{title} ({len(user_ids)}): {shown}"
+
+
+async def process_role_batch(message: types.Message, state: FSMContext, bot: Bot, role: str, granted: bool,
+                             protected: frozenset = frozenset()) -> None:
+    """
+    Выдаёт или снимает роль у всех ID из сообщения или файла.
+    Список проверяется целиком, применяется одним изменением в памяти
+    с одной записью в базу, а ответ - одна сводка по всем записям.
+    protected - ID, которые нельзя изменять (супер-администратор).
+    """
+    try:
+        valid, invalid = await read_user_ids(message, bot)
+    except ValueError as e:
+        await message.answer(f"Не удалось прочитать файл: {e}.")
+        return
+    if not valid:
+        await message.answer(f"Не найдено ни одного корректного ID. Пожалуйста, введите числа.\n{USER_IDS_HINT}")
+        return
+
+    refused = [user_id for user_id in valid if user_id in protected]
+    valid = [user_id for user_id in valid if user_id not in protected]
+    changed = acl_cache.update_role(role, valid, granted)
+    changed_set = set(changed)
+    unchanged = [user_id for user_id in valid if user_id not in changed_set]
+    logging.info(
+        f"Admin {message.from_user.id} {'granted' if granted else 'revoked'} role {role} "
+        f"for {len(changed)} users ({len(unchanged)} unchanged, {len(invalid)} invalid)"
+    )
+
+    changed_title, unchanged_title = ROLE_BATCH_TITLES[(role, granted)]
+    lines = [format_id_group(changed_title, changed)] if changed else ["Изменений нет."]
+    if unchanged:
+        lines.append(format_id_group(unchanged_title, unchanged))
+    if refused:
+        lines.append(format_id_group("Нельзя изменить супер-администратора", refused))
+    if invalid:
+        lines.append(format_id_group("Некорректные записи", invalid))
+    await message.answer("\n\n".join(lines))
+
+    await state.set_state(AdminForm.menu)
+    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+
+
 @router.callback_query(AdminForm.menu, F.data == "admin_add_mechanic")
 async def admin_add_mechanic_prompt(callback_query: types.CallbackQuery, state: FSMContext):
-    """Запрашивает Telegram ID нового механика."""
+    """Запрашивает Telegram ID новых механиков."""
     await callback_query.message.edit_text(
-        "Введите Telegram ID нового механика (это числовой ID, его можно узнать у @userinfobot)."
+        "Введите Telegram ID нового механика (это числовой ID, его можно узнать у @userinfobot).\n\n"
+        + USER_IDS_HINT
     )
     await state.set_state(AdminForm.add_user)
     await callback_query.answer()
 
 
-@router.message(AdminForm.add_user, F.text)
-async def admin_add_mechanic_process(message: types.Message, state: FSMContext):
-    """Добавляет нового механика в список."""
-    user_id_to_add = message.text.strip()
-    if not user_id_to_add.isdigit():
-        await message.answer("Неверный формат ID. Пожалуйста, введите только число.")
-        return
-        
-    authorized_users = load_authorized_users()
-    if user_id_to_add in authorized_users:
-        await message.answer("Этот пользователь уже авторизован.")
-    else:
-        authorized_users.add(user_id_to_add)
-        save_authorized_users(authorized_users)
-        await message.answer(f"Пользователь с ID {user_id_to_add} успешно добавлен.")
-    
-    await state.set_state(AdminForm.menu)
-    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+@router.message(AdminForm.add_user, F.text | F.document)
+async def admin_add_mechanic_process(message: types.Message, state: FSMContext, bot: Bot):
+    """Добавляет новых механиков в список."""
+    await process_role_batch(message, state, bot, ROLE_MECHANIC, True)
 
 
 @router.callback_query(AdminForm.menu, F.data == "admin_add_admin")
 async def admin_add_admin_prompt(callback_query: types.CallbackQuery, state: FSMContext):
-    """Запрашивает Telegram ID нового администратора."""
+    """Запрашивает Telegram ID новых администраторов."""
     await callback_query.message.edit_text(
-        "Введите Telegram ID нового администратора."
+        "Введите Telegram ID нового администратора.\n\n" + USER_IDS_HINT
     )
     await state.set_state(AdminForm.add_admin)
     await callback_query.answer()
 
 
-@router.message(AdminForm.add_admin, F.text)
-async def admin_add_admin_process(message: types.Message, state: FSMContext):
-    """Добавляет нового администратора в список."""
-    admin_id_to_add = message.text.strip()
-    if not admin_id_to_add.isdigit():
-        await message.answer("Неверный формат ID. Пожалуйста, введите только число.")
-        return
-        
-    admins = load_admins()
-    if admin_id_to_add in admins:
-        await message.answer("Этот пользователь уже является администратором.")
-    else:
-        admins.add(admin_id_to_add)
-        save_admins(admins)
-        await message.answer(f"Пользователь с ID {admin_id_to_add} успешно добавлен в список администраторов.")
-    
-    await state.set_state(AdminForm.menu)
-    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+@router.message(AdminForm.add_admin, F.text | F.document)
+async def admin_add_admin_process(message: types.Message, state: FSMContext, bot: Bot):
+    """Добавляет новых администраторов в список."""
+    await process_role_batch(message, state, bot, ROLE_ADMIN, True)
 
 
 @router.callback_query(AdminForm.menu, F.data == "admin_list_mechanics")
 async def admin_list_mechanics(callback_query: types.CallbackQuery, state: FSMContext):
     """Отображает список авторизованных механиков."""
-    authorized_users = load_authorized_users()
+    authorized_users = acl_cache.users()
     
     if not authorized_users:
         message_text = "В списке нет авторизованных механиков."
@@ -805,7 +3515,7 @@ async def admin_list_mechanics(callback_query: types.CallbackQuery, state: FSMCo
 @router.callback_query(AdminForm.menu, F.data == "admin_list_admins")
 async def admin_list_admins(callback_query: types.CallbackQuery, state: FSMContext):
     """Отображает список администраторов."""
-    admins = load_admins()
+    admins = acl_cache.admins()
     
     if not admins:
         message_text = "В списке нет администраторов."
@@ -827,66 +3537,38 @@ async def admin_list_admins(callback_query: types.CallbackQuery, state: FSMConte
 async def admin_remove_mechanic_prompt(callback_query: types.CallbackQuery, state: FSMContext):
     """Запрашивает ID механика для удаления."""
     await callback_query.message.edit_text(
-        "Введите Telegram ID механика, которого хотите удалить."
+        "Введите Telegram ID механика, которого хотите удалить.\n\n" + USER_IDS_HINT
     )
     await state.set_state(AdminForm.remove_user)
     await callback_query.answer()
 
 
-@router.message(AdminForm.remove_user, F.text)
-async def admin_remove_mechanic_process(message: types.Message, state: FSMContext):
-    """Удаляет механика из списка авторизованных."""
-    user_id_to_remove = message.text.strip()
-    if not user_id_to_remove.isdigit():
-        await message.answer("Неверный формат ID. Пожалуйста, введите только число.")
-        return
-        
-    authorized_users = load_authorized_users()
-    if user_id_to_remove in authorized_users:
-        authorized_users.remove(user_id_to_remove)
-        save_authorized_users(authorized_users)
-        await message.answer(f"Пользователь с ID {user_id_to_remove} успешно удален из списка механиков.")
-    else:
-        await message.answer("Пользователь с таким ID не найден в списке механиков.")
-    
-    await state.set_state(AdminForm.menu)
-    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+@router.message(AdminForm.remove_user, F.text | F.document)
+async def admin_remove_mechanic_process(message: types.Message, state: FSMContext, bot: Bot):
+    """Удаляет механиков из списка авторизованных."""
+    await process_role_batch(message, state, bot, ROLE_MECHANIC, False)
 
 
 @router.callback_query(AdminForm.menu, F.data == "admin_remove_admin")
 async def admin_remove_admin_prompt(callback_query: types.CallbackQuery, state: FSMContext):
     """Запрашивает ID администратора для удаления."""
     await callback_query.message.edit_text(
-        "Введите Telegram ID администратора, которого хотите удалить."
+        "Введите Telegram ID администратора, которого хотите удалить.\n\n" + USER_IDS_HINT
     )
     await state.set_state(AdminForm.remove_admin)
     await callback_query.answer()
 
 
-@router.message(AdminForm.remove_admin, F.text)
-async def admin_remove_admin_process(message: types.Message, state: FSMContext):
-    """Удаляет администратора из списка."""
-    admin_id_to_remove = message.text.strip()
-    if not admin_id_to_remove.isdigit():
-        await message.answer("Неверный формат ID. Пожалуйста, введите только число.")
-        return
-        
-    if str(message.from_user.id) == str(SUPER_ADMIN_ID):
-        if admin_id_to_remove == str(SUPER_ADMIN_ID):
-            await message.answer("Вы не можете удалить супер-администратора.")
-        else:
-            admins = load_admins()
-            if admin_id_to_remove in admins:
-                admins.remove(admin_id_to_remove)
-                save_admins(admins)
-                await message.answer(f"Пользователь с ID {admin_id_to_remove} успешно удален из списка администраторов.")
-            else:
-                await message.answer("Пользователь с таким ID не является администратором.")
-    else:
+@router.message(AdminForm.remove_admin, F.text | F.document)
+async def admin_remove_admin_process(message: types.Message, state: FSMContext, bot: Bot):
+    """Удаляет администраторов из списка. Доступно только супер-администратору."""
+    if str(message.from_user.id) != str(SUPER_ADMIN_ID):
         await message.answer("У вас нет прав для удаления других администраторов.")
-    
-    await state.set_state(AdminForm.menu)
-    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+        await state.set_state(AdminForm.menu)
+        await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+        return
+
+    await process_role_batch(message, state, bot, ROLE_ADMIN, False, protected=frozenset({str(SUPER_ADMIN_ID)}))
 
 
 @router.callback_query(AdminForm.menu, F.data == "admin_set_dispatcher_id")
@@ -908,21 +3590,98 @@ async def admin_set_dispatcher_id_process(message: types.Message, state: FSMCont
         await message.answer("Неверный формат ID. Пожалуйста, введите число.")
         return
 
-    config = load_config()
-    config["dispatcher_chat_id"] = int(dispatcher_id)
-    save_config(config)
+    config_cache.set("dispatcher_chat_id", int(dispatcher_id))
     
     await message.answer(f"ID чата диспетчера ({dispatcher_id}) успешно сохранён.")
     await state.set_state(AdminForm.menu)
     await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
 
 
+EXPORT_PROMPT = (
+    "Введите период и, при необходимости, локацию и формат (csv или xlsx).\n"
+    "Например: 01.03.2025 31.03.2025 Пример1 xlsx"
+)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: types.Message, state: FSMContext):
+    """Обработчик команды /export: сразу переходит к выгрузке отчётов."""
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    await state.set_state(AdminForm.export)
+    await message.answer(EXPORT_PROMPT)
+
+
+@router.callback_query(AdminForm.menu, F.data == "admin_export")
+async def admin_export_prompt(callback_query: types.CallbackQuery, state: FSMContext):
+    """Запрашивает параметры выгрузки отчётов."""
+    await callback_query.message.edit_text(EXPORT_PROMPT)
+    await state.set_state(AdminForm.export)
+    await callback_query.answer()
+
+
+def parse_export_request(text: str):
+    """Разбирает «с по [локация] [формат]». Возвращает (с, по, локация, формат) или None."""
+    parts = text.split()
+    if len(parts) < 2:
+        return None
+    try:
+        first_day = datetime.datetime.strptime(parts[0], "%d.%m.%Y").date()
+        last_day = datetime.datetime.strptime(parts[1], "%d.%m.%Y").date()
+    except ValueError:
+        return None
+    rest = parts[2:]
+    file_format = "csv"
+    if rest and rest[-1].lower() in ("csv", "xlsx"):
+        file_format = rest.pop().lower()
+    if first_day > last_day:
+        return None
+    return first_day, last_day, " ".join(rest) or None, file_format
+
+
+@router.message(AdminForm.export, F.text)
+async def admin_export_process(message: types.Message, state: FSMContext):
+    """Выгружает отчёты за период в файл и отправляет его администратору."""
+    request = parse_export_request(message.text.strip())
+    if request is None:
+        await message.answer(f"Не удалось разобрать запрос.\n\n{EXPORT_PROMPT}")
+        return
+    first_day, last_day, location, file_format = request
+    if file_format == "xlsx" and openpyxl is None:
+        await message.answer("Для выгрузки в XLSX на сервере нужен пакет openpyxl. Выберите csv.")
+        return
+
+    await message.answer("⏳ Готовлю выгрузку...")
+    with tempfile.NamedTemporaryFile(suffix=f".{file_format}", delete=False) as f:
+        path = f.name
+    try:
+        records = history_store.iter_range(first_day, last_day, location)
+        count = await asyncio.to_thread(write_report_export, path, records, file_format)
+        if count:
+            filename = f"reports_{first_day:%Y%m%d}_{last_day:%Y%m%d}.{file_format}"
+            await message.answer_document(
+                types.FSInputFile(path, filename=filename),
+                caption=f"Отчётов: {count}" + (f", локация: {location}" if location else ""),
+            )
+        else:
+            await message.answer("За выбранный период отчётов нет.")
+    except Exception as e:
+        logging.error(f"Failed to export reports: {e}")
+        await message.answer(f"❌ Ошибка выгрузки: {e}")
+    finally:
+        os.remove(path)
+
+    await state.set_state(AdminForm.menu)
+    await message.answer("Админ-панель:", reply_markup=get_admin_menu_keyboard())
+
+
 @router.callback_query(F.data == "admin_back_to_menu")
 async def admin_back_to_menu(callback_query: types.CallbackQuery, state: FSMContext):
     """Возвращает в главное меню админ-панели."""
     await state.set_state(AdminForm.menu)
-    await callback_query.message.edit_text("Админ-панель:", reply_markup=get_admin_menu_keyboard())
-    await callback_query.answer()
+    await edit_callback_message(callback_query, "Админ-панель:", reply_markup=get_admin_menu_keyboard())
 
 
 @router.callback_query(AdminForm.menu, F.data == "admin_exit")
@@ -964,29 +3723,694 @@ async def unhandled_message(message: types.Message, state: FSMContext):
     await message.answer("Я не понимаю эту команду. Пожалуйста, используйте кнопки или команду /start.")
     await state.clear()
 
+# --- Загрузка справочников из базы ---
+# Ревизии разделов справочников, уже загруженных в память
+applied_revisions = {}
+
+
+def apply_catalog(new_catalog: Catalog) -> bool:
+    """Подменяет каталог. Возвращает False, если каталог не изменился."""
+    global catalog
+    if new_catalog.version == catalog.version:
+        return False
+    catalog = new_catalog
+    return True
+
+
+def apply_directory(data: dict, revisions: dict):
+    """Загружает в память прочитанные из базы разделы справочников."""
+    applied = {}
+    if "users" in data:
+        applied["users"] = acl_cache.replace(data["users"])
+    if "settings" in data:
+        applied["settings"] = config_cache.replace(data["settings"])
+    if "catalog" in data:
+        apply_catalog(data["catalog"])
+        applied["catalog"] = True
+    for area, ok in applied.items():
+        # Раздел с незаписанными изменениями перечитаем на следующей проверке
+        if ok:
+            applied_revisions[area] = revisions.get(area)
+
+
+def load_directory():
+    """Готовит базу (импорт JSON-файлов, каталог по умолчанию) и загружает справочники в память."""
+    directory.migrate(DEFAULT_REPAIR_CATEGORIES, DEFAULT_LOCATIONS)
+    revisions = directory.revisions()
+    data = directory.read(DIRECTORY_AREAS)
+    data["catalog"] = Catalog(*data["catalog"], WORK_RENAMES)
+    apply_directory(data, revisions)
+    if not os.path.exists(CATALOG_FILE):
+        write_catalog_file(catalog)
+    logging.info(f"Repair catalog version {catalog.version}: {catalog.works_count()} works, "
+                 f"{len(catalog.locations)} locations; access: {acl_cache.stats()}")
+
+
+async def watch_directory(interval: float = DIRECTORY_CHECK_INTERVAL, export_catalog: bool = True):
+    """
+    Перечитывает разделы справочников, изменившиеся в базе, без перезапуска бота.
+    Если export_catalog, изменившийся каталог выгружается в CATALOG_FILE.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            revisions = await asyncio.to_thread(directory.revisions)
+            changed = [area for area in DIRECTORY_AREAS if revisions.get(area) != applied_revisions.get(area)]
+            if changed:
+                data = await asyncio.to_thread(directory.read, changed)
+                if "catalog" in data:
+                    # Индексы и клавиатуры нового каталога собираются в фоновом потоке
+                    data["catalog"] = await asyncio.to_thread(Catalog, *data["catalog"], WORK_RENAMES)
+                apply_directory(data, revisions)
+                logging.info(f"Reloaded directory: {', '.join(changed)} (catalog version {catalog.version})")
+                if "catalog" in data and export_catalog:
+                    await asyncio.to_thread(write_catalog_file, data["catalog"])
+        except OSError as e:
+            logging.error(f"Failed to export catalog to {CATALOG_FILE}: {e}")
+        except ValueError as e:
+            logging.error(f"Invalid catalog in the database, keeping the current one: {e}")
+        except sqlite3.Error as e:
+            logging.error(f"Failed to reload directory: {e}")
+
+
+# --- Метрики ---
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_metric_labels(labelnames, labels, extra: str = "") -> str:
+    parts = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, labels=(), value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{format_metric_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = format_metric_labels(self.labelnames, labels, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            bucket_labels = format_metric_labels(self.labelnames, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{bucket_labels} {count}"
+            yield f"{self.name}_sum{format_metric_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{format_metric_labels(self.labelnames, labels)} {count}"
+
+
+class Gauge:
+    """
+    Значение считывается функцией в момент запроса метрик.
+    Функции, которые ходят в базу (blocking=True), MetricsRegistry.refresh
+    вызывает в отдельном потоке, чтобы не останавливать цикл событий.
+    """
+
+    def __init__(self, name: str, documentation: str, read, kind: str = "gauge", blocking: bool = False):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.kind = kind
+        self.blocking = blocking
+        self.value = None
+
+    def render(self):
+        value = self.value if self.blocking else self.read()
+        if value is None:
+            return
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield f"{self.name} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    async def refresh(self):
+        """Считывает в потоке значения показателей, которые нельзя читать в цикле событий."""
+        for metric in self._metrics:
+            if getattr(metric, "blocking", False):
+                try:
+                    metric.value = await asyncio.to_thread(metric.read)
+                except Exception as e:
+                    metric.value = None
+                    logging.error(f"Failed to collect metric {metric.name}: {e}")
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logging.error(f"Failed to collect metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+UPDATE_SECONDS = metrics.register(Histogram(
+    "mhelperbot_update_seconds", "Время обработки обновления целиком", ("event_type", "state")))
+HANDLER_SECONDS = metrics.register(Histogram(
+    "mhelperbot_handler_seconds", "Время работы обработчика", ("handler", "state")))
+HANDLER_ERRORS = metrics.register(Counter(
+    "mhelperbot_handler_errors_total", "Исключения в обработчиках", ("handler", "error")))
+API_SECONDS = metrics.register(Histogram(
+    "mhelperbot_api_seconds", "Время запросов к Bot API", ("method",)))
+API_ERRORS = metrics.register(Counter(
+    "mhelperbot_api_errors_total", "Ошибки запросов к Bot API", ("method", "error")))
+LOOP_LAG_SECONDS = metrics.register(Histogram(
+    "mhelperbot_event_loop_lag_seconds", "Задержка цикла событий asyncio"))
+SLOW_UPDATES = metrics.register(Counter(
+    "mhelperbot_slow_updates_total", "Обновления дольше SLOW_UPDATE_THRESHOLD", ("event_type",)))
+
+
+def register_service_gauges(storage: BaseStorage):
+    """Регистрирует показатели состояния бота."""
+    if isinstance(storage, SQLiteStorage):
+        active_sessions = storage.active_sessions
+    else:
+        def active_sessions():
+            return sum(1 for record in getattr(storage, "storage", {}).values() if record.state is not None)
+
+    metrics.register(Gauge("mhelperbot_pending_reports", "Отчёты, ожидающие решения диспетчера",
+                           report_store.count, blocking=True))
+    metrics.register(Gauge("mhelperbot_fsm_active_sessions", "Пользователи с незаконченной формой",
+                           active_sessions))
+    metrics.register(Gauge("mhelperbot_outbox_depth", "Сообщения в исходящей очереди",
+                           lambda: outbox.depth()))
+    metrics.register(Gauge("mhelperbot_outbox_sent_total", "Отправлено через исходящую очередь",
+                           lambda: outbox.sent, "counter"))
+    metrics.register(Gauge("mhelperbot_outbox_failed_total", "Не удалось отправить через исходящую очередь",
+                           lambda: outbox.failed, "counter"))
+    metrics.register(Gauge("mhelperbot_acl_lookups_total", "Проверки прав",
+                           lambda: acl_cache.lookups, "counter"))
+    metrics.register(Gauge("mhelperbot_acl_reloads_total", "Загрузки списков доступа из базы",
+                           lambda: acl_cache.reloads, "counter"))
+    metrics.register(Gauge("mhelperbot_edits_skipped_total", "Правки сообщений, пропущенные как повторные",
+                           lambda: rendered_messages.skipped, "counter"))
+    metrics.register(Gauge("mhelperbot_edits_markup_only_total", "Правки только клавиатуры без текста",
+                           lambda: rendered_messages.markup_only, "counter"))
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware: время обработки обновления по типу события и состоянию FSM."""
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe((event.event_type, data.get("raw_state") or "none"), time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: время конкретного обработчика.
+    Внешний middleware ещё не знает, какой обработчик выберет роутер,
+    поэтому имя обработчика доступно только здесь.
+    """
+
+    async def __call__(self, handler, event, data: dict):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc((name, type(e).__name__))
+            raise
+        finally:
+            HANDLER_SECONDS.observe((name, data.get("raw_state") or "none"), time.perf_counter() - started)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot API: время каждого метода (sendMessage, editMessageText и т.д.)."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            with trace_span(f"api.{name}"):
+                return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc((name, type(e).__name__))
+            raise
+        finally:
+            API_SECONDS.observe((name,), time.perf_counter() - started)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware: заводит трассировку на каждое обновление и пишет
+    в лог обновления дольше threshold секунд с разбивкой по шагам.
+    """
+
+    def __init__(self, threshold: float = SLOW_UPDATE_THRESHOLD):
+        self.threshold = threshold
+        # Обновления, которые обрабатываются прямо сейчас, для монитора цикла событий
+        self.in_flight = set()
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        trace = UpdateTrace(event.update_id, event.event_type)
+        token = current_trace.set(trace)
+        self.in_flight.add(trace)
+        try:
+            return await handler(event, data)
+        except Exception:
+            logging.error(f"Update {trace.update_id} [trace {trace.trace_id}] failed after "
+                          f"{trace.elapsed() * 1000:.1f}ms: {trace.format_spans()}")
+            raise
+        finally:
+            self.in_flight.discard(trace)
+            current_trace.reset(token)
+            elapsed = trace.elapsed()
+            if elapsed > self.threshold:
+                SLOW_UPDATES.inc((trace.event_type,))
+                logging.warning(f"Slow update {trace.update_id} ({trace.event_type}) [trace {trace.trace_id}] "
+                                f"took {elapsed * 1000:.1f}ms: {trace.format_spans()}")
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD,
+                           tracer: TracingMiddleware = None):
+    """
+    Засыпает на interval секунд и смотрит, насколько позже проснулся.
+    Опоздание означает, что цикл событий был занят блокирующим кодом.
+    """
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - started - interval
+        LOOP_LAG_SECONDS.observe((), lag)
+        if lag > threshold:
+            running = ""
+            if tracer is not None and tracer.in_flight:
+                running = "; updates in flight: " + ", ".join(
+                    f"{trace.update_id} [trace {trace.trace_id}]" for trace in tracer.in_flight
+                )
+            logging.warning(f"Event loop was blocked for {lag * 1000:.0f}ms{running}")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Запускает HTTP-сервер с метриками в формате Prometheus."""
+
+    async def handle(request: web.Request) -> web.Response:
+        await metrics.refresh()
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+
+# --- Вебхук ---
+class WebhookHandler:
+    """
+    Принимает обновления от Telegram по HTTP.
+    Сразу отвечает 200 и обрабатывает обновление в фоне; одновременно
+    обрабатывается не больше max_concurrency обновлений, а при переполнении
+    очереди возвращается 503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET,
+                 max_concurrency: int = WEBHOOK_MAX_CONCURRENCY, max_backlog: int = WEBHOOK_MAX_BACKLOG):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.max_backlog = max_backlog
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+        if len(self._tasks) >= self.max_backlog:
+            return web.Response(status=503)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        async with self._semaphore:
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception:
+                logging.exception(f"Failed to process update {update.update_id}")
+
+    async def close(self, *args):
+        """Дожидается обработки уже принятых обновлений."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def build_webhook_app(dispatcher: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                      max_concurrency: int = WEBHOOK_MAX_CONCURRENCY) -> web.Application:
+    """Собирает aiohttp-приложение для вебхука. bot может использовать любую сессию, в том числе тестовую."""
+    app = web.Application()
+    handler = WebhookHandler(dispatcher, bot, secret=secret, max_concurrency=max_concurrency)
+    app.router.add_post(path, handler.handle)
+    app.on_shutdown.append(handler.close)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot, args: argparse.Namespace):
+    """Запускает HTTP-сервер вебхука и регистрирует его в Telegram."""
+    app = build_webhook_app(dispatcher, bot, path=args.webhook_path, secret=args.webhook_secret,
+                            max_concurrency=args.webhook_concurrency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.webhook_host, args.webhook_port).start()
+    logging.info(f"Webhook server listening on {args.webhook_host}:{args.webhook_port}{args.webhook_path}")
+    if args.webhook_url:
+        await bot.set_webhook(
+            args.webhook_url.rstrip("/") + args.webhook_path,
+            secret_token=args.webhook_secret or None,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# --- Многопроцессный режим ---
+def get_update_user_id(update: types.Update) -> int:
+    """ID пользователя, от которого пришло обновление (0, если его нет)."""
+    user = getattr(update.event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update.event, "chat", None)
+    return chat.id if chat is not None else 0
+
+
+class UpdateSharder:
+    """
+    Раздаёт обновления рабочим процессам по ID пользователя, чтобы
+    форма одного механика всегда обрабатывалась одним процессом.
+    Повторяет интерфейс Dispatcher.feed_update, поэтому подходит для WebhookHandler.
+    """
+
+    def __init__(self, inboxes):
+        self.inboxes = inboxes
+
+    def shard_for(self, user_id: int) -> int:
+        return abs(user_id) % len(self.inboxes)
+
+    async def feed_update(self, bot: Bot, update: types.Update):
+        inbox = self.inboxes[self.shard_for(get_update_user_id(update))]
+        raw = update.model_dump(mode="json", exclude_unset=True)
+        try:
+            inbox.put_nowait(raw)
+        except queue.Full:
+            await asyncio.to_thread(inbox.put, raw)
+
+
+async def poll_updates(bot: Bot, sharder: UpdateSharder, allowed_updates):
+    """Получает обновления через getUpdates и передаёт их рабочим процессам."""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logging.error(f"Failed to fetch updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await sharder.feed_update(bot, update)
+            offset = update.update_id + 1
+
+
+async def run_supervisor(args: argparse.Namespace):
+    """
+    Запускает args.workers рабочих процессов и раздаёт им обновления.
+    Процессы делят справочники (списки доступа, настройки, каталог),
+    отчёты и формы через общую базу SQLite.
+    """
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(args.workers)]
+    processes = [
+        context.Process(target=run_worker, args=(index, inbox, args), name=f"mhelperbot-worker-{index}")
+        for index, inbox in enumerate(inboxes)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {len(processes)} worker processes")
+
+    sharder = UpdateSharder(inboxes)
+    bot = create_bot()
+    # Диспетчер главного процесса нужен только, чтобы узнать используемые типы обновлений
+    intake = Dispatcher(storage=MemoryStorage())
+    intake.include_router(router)
+    allowed_updates = intake.resolve_used_update_types()
+    try:
+        if args.mode == "webhook":
+            app = web.Application()
+            app.router.add_post(args.webhook_path, WebhookHandler(sharder, bot, secret=args.webhook_secret).handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, args.webhook_host, args.webhook_port).start()
+            if args.webhook_url:
+                await bot.set_webhook(args.webhook_url.rstrip("/") + args.webhook_path,
+                                      secret_token=args.webhook_secret or None, allowed_updates=allowed_updates)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await runner.cleanup()
+        else:
+            await poll_updates(bot, sharder, allowed_updates)
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 30)
+        await bot.session.close()
+
+
+def run_worker(index: int, inbox, args: argparse.Namespace):
+    """Точка входа рабочего процесса."""
+    try:
+        asyncio.run(worker_main(index, inbox, args))
+    except KeyboardInterrupt:
+        pass
+
+
+async def worker_main(index: int, inbox, args: argparse.Namespace):
+    """Обрабатывает обновления, которые главный процесс присылает в inbox."""
+    # Отчёт может быть принят в другом процессе, поэтому читаем его только из базы
+    report_store.cache_size = 0
+    # Тот же велосипед может прийти от механика из другого процесса
+    recent_repairs.shared = True
+    outbox.share_limits(args.workers)
+
+    bot = create_bot()
+    dp = create_dispatcher(trace=args.trace, slow_update_threshold=args.slow_update_ms / 1000)
+    semaphore = asyncio.Semaphore(args.webhook_concurrency)
+    tasks = set()
+
+    async def process(update: types.Update):
+        async with semaphore:
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                logging.exception(f"Worker {index} failed to process update {update.update_id}")
+
+    metrics_runner = None
+    if args.metrics_port:
+        metrics_runner = await start_metrics_server(METRICS_HOST, args.metrics_port + index)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    async with background_services(bot, primary=index == 0, tracer=dp.get("tracer")):
+        try:
+            while True:
+                raw = await asyncio.to_thread(inbox.get)
+                if raw is None:
+                    break
+                task = asyncio.create_task(process(types.Update.model_validate(raw, context={"bot": bot})))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
+            await bot.session.close()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Telegram-бот для механиков")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=RUN_MODE,
+                        help="способ получения обновлений")
+    parser.add_argument("--webhook-host", default=WEBHOOK_HOST)
+    parser.add_argument("--webhook-port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--webhook-path", default=WEBHOOK_PATH)
+    parser.add_argument("--webhook-url", default=WEBHOOK_URL, help="публичный адрес для setWebhook")
+    parser.add_argument("--webhook-secret", default=WEBHOOK_SECRET)
+    parser.add_argument("--webhook-concurrency", type=int, default=WEBHOOK_MAX_CONCURRENCY)
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES,
+                        help="количество рабочих процессов")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="порт HTTP-сервера метрик Prometheus, 0 - отключить")
+    parser.add_argument("--import-json", action="store_true",
+                        help="импортировать в базу authorized_users.json, admins.json и config.json и выйти")
+    parser.add_argument("--trace", action="store_true", default=TRACE_UPDATES,
+                        help="трассировать обновления и писать в лог медленные")
+    parser.add_argument("--slow-update-ms", type=float, default=SLOW_UPDATE_THRESHOLD * 1000,
+                        help="с какой длительности (в мс) обновление считается медленным")
+    return parser.parse_args(argv)
+
+
 # --- Главная функция ---
-async def main():
+def create_bot() -> Bot:
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=None))
+    bot.session.middleware(ApiMetricsMiddleware())
+    bot.session.middleware(RenderedMessagesMiddleware())
+    return bot
+
+
+async def stop_services():
+    """
+    Дописывает отложенные изменения в едином для всех режимов порядке:
+    отметки работ -> сводки -> исходящая очередь -> справочники.
+    Вызывается при остановке диспетчера до закрытия хранилища FSM и сессии бота.
+    Повторный вызов ничего не делает.
+    """
+    await work_toggles.close()
+    await digest_buffer.close()
+    await outbox.stop()
+    await deferred_writer.close()
+
+
+def create_dispatcher(trace: bool = TRACE_UPDATES, slow_update_threshold: float = SLOW_UPDATE_THRESHOLD,
+                      storage: str = None) -> Dispatcher:
+    dp = Dispatcher(storage=create_fsm_storage(storage))
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    if trace:
+        dp["tracer"] = dp.update.outer_middleware(TracingMiddleware(slow_update_threshold))
+    router.callback_query.middleware(DuplicateCallbackMiddleware())
+    for observer in (router.message, router.callback_query, router.inline_query):
+        observer.middleware(HandlerMetricsMiddleware())
+        observer.middleware(WorkTogglesMiddleware())
+    dp.include_router(router)
+    # Первым обработчиком shutdown aiogram закрывает хранилище FSM, а отложенные
+    # изменения нужно дописать раньше, поэтому ставим stop_services перед ним
+    dp.shutdown.register(stop_services)
+    dp.shutdown.handlers.insert(0, dp.shutdown.handlers.pop())
+    register_service_gauges(dp.storage)
+    load_directory()
+    warm_keyboard_cache()
+    return dp
+
+
+@contextlib.asynccontextmanager
+async def background_services(bot: Bot, primary: bool = True, tracer: TracingMiddleware = None):
+    """
+    Запускает фоновые задачи бота и останавливает их при выходе.
+    Задачи обслуживания общей базы выполняет только основной процесс.
+    """
+    purge_task = asyncio.create_task(purge_reports_periodically()) if primary else None
+    lag_task = asyncio.create_task(monitor_loop_lag(tracer=tracer))
+    directory_task = asyncio.create_task(watch_directory(export_catalog=primary))
+    outbox.start()
+    await asyncio.to_thread(recent_repairs.rebuild)
+    if primary:
+        await digest_buffer.restore(bot)
+    try:
+        yield
+    finally:
+        if purge_task is not None:
+            purge_task.cancel()
+        lag_task.cancel()
+        directory_task.cancel()
+        # Обычно уже вызвано при остановке диспетчера; здесь на случай, если до неё не дошло
+        await stop_services()
+        logging.info(f"Outbound queue stats: {outbox.stats()}")
+        report_store.close()
+        history_store.close()
+        directory.close()
+        logging.info(f"ACL cache stats: {acl_cache.stats()}")
+
+
+async def main(args: argparse.Namespace = None):
     """Запускает бота."""
+    args = args or parse_args([])
     print_ascii_art()
-    
-    # Создаем файлы, если их нет
-    if not os.path.exists(AUTHORIZED_USERS_FILE):
-        with open(AUTHORIZED_USERS_FILE, "w") as f:
-            json.dump([], f)
-    if not os.path.exists(ADMINS_FILE):
-        with open(ADMINS_FILE, "w") as f:
-            json.dump([], f)
-    if not os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "w") as f:
-            json.dump({}, f)
+
+    if args.import_json:
+        counts = directory.import_json_files()
+        logging.info(f"Imported JSON configuration files into {directory.path}: {counts}")
+        directory.close()
+        return
+
+    if args.workers > 1:
+        await run_supervisor(args)
+        return
 
     # Инициализируем бота
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=None))
-    dp = Dispatcher()
-    dp.include_router(router)
-    
-    await dp.start_polling(bot)
+    bot = create_bot()
+    dp = create_dispatcher(trace=args.trace, slow_update_threshold=args.slow_update_ms / 1000)
+    metrics_runner = await start_metrics_server(METRICS_HOST, args.metrics_port) if args.metrics_port else None
+
+    try:
+        async with background_services(bot, tracer=dp.get("tracer")):
+            if args.mode == "webhook":
+                await run_webhook(dp, bot, args)
+            else:
+                await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
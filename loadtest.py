@@ -0,0 +1,258 @@
+"""
+Нагрузочный тест бота без сети.
+
+Запускает диспетчер из bot.py с поддельной сессией Bot API, которая отвечает
+на запросы в том же процессе. N механиков одновременно проходят всю форму
+(/start -> номер -> тип -> локация -> категория -> работы -> подтверждение),
+а диспетчеры принимают пришедшие отчёты. В конце выводится пропускная
+способность, p50/p95/p99 по каждому шагу и доля ошибок.
+
+Пример:
+    python loadtest.py --mechanics 200 --toggles 6 --dispatchers 3
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from aiogram import Bot, types
+from aiogram.client.session.base import BaseSession
+
+import bot as mhelperbot
+
+DISPATCHER_CHAT_ID = -1000000000001
+DISPATCHER_USER_ID = 900000000
+FIRST_MECHANIC_ID = 100000000
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия Bot API, которая не ходит в сеть.
+    Запоминает отправленные сообщения и передаёт отчёты диспетчерам через reports.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.reports = asyncio.Queue()
+        self.calls = defaultdict(int)
+        self.alerts = defaultdict(int)
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name == "AnswerCallbackQuery":
+            if method.show_alert:
+                self.alerts[method.text] += 1
+            return True
+        if name in ("SendMessage", "EditMessageText", "SendDocument"):
+            chat_id = method.chat_id
+            message = types.Message(
+                message_id=getattr(method, "message_id", None) or next(self._message_ids),
+                date=datetime.datetime.now(),
+                chat=types.Chat(id=chat_id, type="supergroup" if int(chat_id) < 0 else "private"),
+                text=getattr(method, "text", None),
+                reply_markup=getattr(method, "reply_markup", None),
+            ).as_(bot)
+            if name == "SendMessage" and chat_id == DISPATCHER_CHAT_ID and method.reply_markup:
+                for row in method.reply_markup.inline_keyboard:
+                    for button in row:
+                        if button.callback_data.startswith("accept_"):
+                            await self.reports.put((message, button.callback_data))
+            return message
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+class LoadTest:
+    """Прогоняет сценарии механиков и диспетчеров и собирает задержки по шагам."""
+
+    def __init__(self, bot: Bot, dispatcher, session: FakeTelegramSession):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.session = session
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._update_ids = itertools.count(1)
+
+    async def feed(self, step: str, payload: dict):
+        update = types.Update.model_validate(
+            {"update_id": next(self._update_ids), **payload}, context={"bot": self.bot}
+        )
+        started = time.perf_counter()
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[step] += 1
+            logging.debug(f"{step} failed: {e}")
+        self.latencies[step].append(time.perf_counter() - started)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {
+            "message": {
+                "message_id": random.randint(1, 2 ** 31),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+            }
+        }
+
+    def callback(self, user_id: int, data: str, chat_id: int = None, text: str = "") -> dict:
+        chat_id = chat_id or user_id
+        return {
+            "callback_query": {
+                "id": str(random.getrandbits(63)),
+                "from": self._user(user_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": random.randint(1, 2 ** 31),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                    "text": text,
+                },
+            }
+        }
+
+    async def mechanic(self, index: int, toggles: int):
+        user_id = FIRST_MECHANIC_ID + index
+        catalog = mhelperbot.catalog
+        category = random.choice(list(catalog.categories))
+        works = random.sample(catalog.categories[category], min(toggles, len(catalog.categories[category])))
+
+        await self.feed("start", self.message(user_id, "/start"))
+        await self.feed("bike_id", self.message(user_id, f"AB{index % 1000:03d}C"))
+        await self.feed("repair_type", self.callback(user_id, "type_Быстрый ремонт"))
+        await self.feed("location", self.callback(user_id, f"loc_{catalog.locations[0]}"))
+        await self.feed("category", self.callback(user_id, f"category_{catalog.reverse_category_callbacks[category]}"))
+        for work in works:
+            await self.feed("work_toggle", self.callback(user_id, f"work_{catalog.work_callbacks[work]}"))
+        await self.feed("confirm", self.callback(user_id, "confirm"))
+        await self.feed("final_confirm", self.callback(user_id, "final_confirm"))
+
+    async def dispatcher_loop(self, index: int):
+        while True:
+            message, data = await self.session.reports.get()
+            await self.feed("accept", self.callback(DISPATCHER_USER_ID + index, data, DISPATCHER_CHAT_ID, message.text))
+            self.session.reports.task_done()
+
+    def report(self, elapsed: float) -> dict:
+        total = sum(len(values) for values in self.latencies.values())
+        steps = {}
+        for step, values in self.latencies.items():
+            values = sorted(values)
+
+            def percentile(p):
+                return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+            steps[step] = {
+                "count": len(values),
+                "errors": self.errors[step],
+                "p50_ms": round(percentile(0.50), 3),
+                "p95_ms": round(percentile(0.95), 3),
+                "p99_ms": round(percentile(0.99), 3),
+            }
+        return {
+            "updates": total,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+            "error_rate": round(sum(self.errors.values()) / total, 4) if total else 0.0,
+            "alerts": dict(self.session.alerts),
+            "api_calls": dict(self.session.calls),
+            "steps": steps,
+        }
+
+
+def print_report(result: dict):
+    print(f"Обновлений: {result['updates']} за {result['elapsed_s']} с "
+          f"({result['throughput_per_s']} в секунду), доля ошибок: {result['error_rate']:.2%}")
+    print(f"{'шаг':<14}{'кол-во':>8}{'ошибки':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for step, stats in result["steps"].items():
+        print(f"{step:<14}{stats['count']:>8}{stats['errors']:>8}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    if result["alerts"]:
+        print(f"Предупреждения пользователям: {result['alerts']}")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Запускает тест во временном каталоге, чтобы не трогать рабочие файлы бота."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="mhelperbot-loadtest-") as workdir:
+        os.chdir(workdir)
+        try:
+            return await run_in_workdir(args)
+        finally:
+            os.chdir(cwd)
+
+
+async def run_in_workdir(args: argparse.Namespace) -> dict:
+    with open(mhelperbot.AUTHORIZED_USERS_FILE, "w") as f:
+        json.dump([str(FIRST_MECHANIC_ID + i) for i in range(args.mechanics)], f)
+    with open(mhelperbot.ADMINS_FILE, "w") as f:
+        json.dump([], f)
+    with open(mhelperbot.CONFIG_FILE, "w") as f:
+        json.dump({"dispatcher_chat_id": DISPATCHER_CHAT_ID}, f)
+
+    # Лимиты Telegram измеряют не бота, а очередь, поэтому по умолчанию их снимаем
+    if not args.real_limits:
+        mhelperbot.outbox = mhelperbot.OutboundQueue(global_rate=1e9, group_rate=1e9, private_rate=1e9)
+
+    session = FakeTelegramSession(latency=args.api_latency / 1000)
+    test_bot = Bot(token="123456:LOADTEST", session=session)
+    dp = mhelperbot.create_dispatcher(storage=args.storage)
+    test = LoadTest(test_bot, dp, session)
+
+    async with mhelperbot.background_services(test_bot):
+        dispatchers = [asyncio.create_task(test.dispatcher_loop(i)) for i in range(args.dispatchers)]
+        started = time.perf_counter()
+        await asyncio.gather(*(test.mechanic(i, args.toggles) for i in range(args.mechanics)))
+        await session.reports.join()
+        elapsed = time.perf_counter() - started
+        for task in dispatchers:
+            task.cancel()
+        # Останавливаем так же, как бот: отложенные изменения, затем хранилище FSM
+        await dp.emit_shutdown(bot=test_bot, dispatcher=dp)
+    return test.report(elapsed)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельным Bot API")
+    parser.add_argument("--mechanics", type=int, default=100, help="сколько механиков заполняют форму одновременно")
+    parser.add_argument("--toggles", type=int, default=5, help="сколько работ отмечает каждый механик")
+    parser.add_argument("--dispatchers", type=int, default=2, help="сколько диспетчеров принимают отчёты")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory", help="хранилище FSM")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--real-limits", action="store_true", help="оставить лимиты Telegram в исходящей очереди")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    arguments = parse_args()
+    result = asyncio.run(run(arguments))
+    if arguments.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)